@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+"""Just enough of albert's python API (v0.4) to load the extensions outside albert.
+
+Items and actions only record what they were built with. The cache directory
+comes from $ALBERT_BENCH_CACHE so every run can start cold."""
+
+import os
+import sys
+import tempfile
+
+_verbose = bool(os.environ.get("ALBERT_BENCH_VERBOSE"))
+
+
+def _log(level: str):
+    def log(message: str):
+        if _verbose or level not in ("debug", "info"):
+            print(f"[{level}] {message}", file=sys.stderr)
+
+    return log
+
+
+debug = _log("debug")
+info = _log("info")
+warning = _log("warning")
+error = _log("error")
+critical = _log("critical")
+
+
+def iconLookup(name: str) -> str:
+    return ""
+
+
+def cacheLocation() -> str:
+    return os.environ.get("ALBERT_BENCH_CACHE") or os.path.join(tempfile.gettempdir(), "albert-bench")
+
+
+def configLocation() -> str:
+    return os.path.join(cacheLocation(), "config")
+
+
+def dataLocation() -> str:
+    return os.path.join(cacheLocation(), "data")
+
+
+class _Recorded:
+    def __init__(self, *args, **kwargs):
+        self.args = args
+        self.__dict__.update(kwargs)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.__dict__})"
+
+
+class Item(_Recorded):
+    pass
+
+
+class UrlAction(_Recorded):
+    pass
+
+
+class ClipAction(_Recorded):
+    pass
+
+
+class FuncAction(_Recorded):
+    pass
+
+
+class ProcAction(_Recorded):
+    pass
+
+
+class Query:
+    def __init__(self, string: str, trigger: str = ""):
+        self.string = string
+        self.rawString = trigger + string
+        self.trigger = trigger
+        self.isTriggered = True
+        self.isValid = True
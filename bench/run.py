@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark the extensions against the local stand-in servers.
+
+Every extension runs cold in its own process (empty cache directory, fresh
+import) against a shared bench server, and reports:
+
+- refresh: wall time from initialize() until the first refresh has landed
+- transferred: response bytes sent by the server during that refresh
+- peak RSS of the extension process
+- p50/p99 handleQuery latency while typing a set of queries key by key
+
+Usage: python bench/run.py [--size N] [--latency SECONDS] [--page-size N]"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from configparser import ConfigParser
+from typing import Dict, List
+from urllib import request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+EXTENSIONS = ("linkding", "paperless", "wallabag")
+# Typed one key at a time, a mix of hits, multi-word queries and misses
+QUERIES = ("invoice", "bank tax", "linux server backup", "holiday", "zzz", "pyhton")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the albert extensions against local stub servers")
+    parser.add_argument("--size", type=int, default=1000, help="items per service")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--page-size", type=int, default=100, help="results_per_page for linkding and wallabag")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds to wait for a refresh")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("extensions", nargs="*", default=EXTENSIONS, help=f"any of {', '.join(EXTENSIONS)}")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    parser.add_argument("--base-url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        print(json.dumps(run_worker(args.worker, args.base_url, args.page_size, args.timeout)))
+        return
+    unknown = set(args.extensions) - set(EXTENSIONS)
+    if unknown:
+        parser.error(f"unknown extensions: {', '.join(sorted(unknown))}")
+
+    sys.path.insert(0, BENCH_DIR)
+    from server import serve
+
+    server = serve(args.size, args.latency)
+    print(f"{args.size} items per service, {args.latency * 1000:.0f}ms latency, page size {args.page_size}")
+    results = {}
+    for extension in args.extensions:
+        worker = subprocess.run(
+            [
+                sys.executable, __file__, "--worker", extension, "--base-url", server.base_url,
+                "--page-size", str(args.page_size), "--timeout", str(args.timeout),
+            ],
+            stdout=subprocess.PIPE,
+            check=True,
+        )
+        results[extension] = json.loads(worker.stdout)
+        print(format_result(extension, results[extension]))
+    server.shutdown()
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump({"size": args.size, "latency": args.latency, "results": results}, output, indent=2)
+
+
+def run_worker(extension: str, base_url: str, page_size: int, timeout: float) -> Dict:
+    workdir = tempfile.mkdtemp(prefix=f"albert-bench-{extension}-")
+    try:
+        os.environ["ALBERT_BENCH_CACHE"] = os.path.join(workdir, "cache")
+        modules, downloads = os.path.join(workdir, "modules"), os.path.join(workdir, "downloads")
+        install(extension, modules, base_url, page_size, downloads)
+        sys.path[:0] = [BENCH_DIR, modules]
+        import albert
+
+        module = __import__(extension)
+
+        sent = transferred(base_url)
+        start = time.perf_counter()
+        module.initialize()
+        initialize_time = time.perf_counter() - start
+        config = module.config
+        while config.synced is None or config.loading:
+            if time.perf_counter() - start > timeout:
+                raise TimeoutError(f"{extension} didn't finish refreshing within {timeout}s")
+            time.sleep(0.005)
+        refresh_time = time.perf_counter() - start
+        refresh_bytes = transferred(base_url) - sent
+
+        latencies = []
+        for query_string in QUERIES:
+            for length in range(1, len(query_string) + 1):
+                query = albert.Query(query_string[:length])
+                start = time.perf_counter()
+                module.handleQuery(query)
+                latencies.append(time.perf_counter() - start)
+
+        return {
+            "initialize": initialize_time,
+            "refresh": refresh_time,
+            "transferred": refresh_bytes,
+            "peak_rss": peak_rss(),
+            "keystrokes": len(latencies),
+            "p50": percentile(latencies, 50),
+            "p99": percentile(latencies, 99),
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def install(extension: str, modules_dir: str, base_url: str, page_size: int, download_path: str):
+    """Copy the extension like `make` would and point its config at the bench server."""
+    target = os.path.join(modules_dir, extension)
+    shutil.copytree(os.path.join(ROOT_DIR, "src", extension), target)
+    shutil.copytree(os.path.join(ROOT_DIR, "src", "common"), os.path.join(target, "common"))
+    config = ConfigParser()
+    config.read(os.path.join(ROOT_DIR, "config", extension, "config.ini"))
+    section = config[extension]
+    overrides = {
+        "base_url": base_url,
+        "api_token": "bench",
+        "username": "bench",
+        "password": "bench",
+        "client_id": "bench",
+        "client_secret": "bench",
+        "results_per_page": str(page_size),
+        "download_path": download_path,
+        # Icons would come from the bookmarked sites, keep the benchmark offline
+        "icon_cache_size": "0",
+    }
+    for key, value in overrides.items():
+        if key in section:
+            section[key] = value
+    with open(os.path.join(target, "config.ini"), "w") as config_file:
+        config.write(config_file)
+
+
+def transferred(base_url: str) -> int:
+    with request.urlopen(f"{base_url}/_bench/bytes") as response:
+        return json.load(response)["bytes"]
+
+
+def peak_rss() -> int:
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return usage if sys.platform == "darwin" else usage * 1024
+
+
+def percentile(samples: List[float], percent: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+def format_result(extension: str, result: Dict) -> str:
+    return (
+        f"{extension:<10} refresh {result['refresh']:7.3f}s  "
+        f"transferred {result['transferred'] / 1024 / 1024:8.2f}MB  "
+        f"peak RSS {result['peak_rss'] / 1024 / 1024:7.1f}MB  "
+        f"handleQuery p50 {result['p50'] * 1000:6.2f}ms p99 {result['p99'] * 1000:6.2f}ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
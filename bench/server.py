@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+
+"""Stand-in for the linkding, paperless and wallabag APIs.
+
+Serves synthetic, reproducible datasets with the same shapes and pagination
+as the real services, plus a configurable delay on every request. Only the
+endpoints and parameters the extensions actually use are implemented.
+
+`/_bench/bytes` reports how many response bytes have been sent so far."""
+
+import json
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib import parse
+
+WORDS = (
+    "python rust linux albert paper invoice receipt amazon bank tax recipe music travel cloud server backup "
+    "photo news garden kitchen insurance contract manual warranty holiday school doctor energy water phone"
+).split()
+
+
+class Dataset:
+    """Synthetic bookmarks, documents and entries, the same for the same seed."""
+
+    def __init__(self, size: int, body_size: int = 2000, seed: int = 1):
+        rng = random.Random(seed)
+        epoch = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+        def title() -> str:
+            return " ".join(rng.choice(WORDS).capitalize() for _ in range(rng.randint(3, 6)))
+
+        def body() -> str:
+            return " ".join(rng.choice(WORDS) for _ in range(body_size // 6))
+
+        def stamp(i: int) -> str:
+            return (epoch + timedelta(hours=i)).isoformat()
+
+        self.tags = [{"id": i, "slug": word, "name": word.capitalize()} for i, word in enumerate(WORDS, 1)]
+        self.document_types = [
+            {"id": i, "slug": slug, "name": slug.capitalize()}
+            for i, slug in enumerate(("receipt", "letter", "invoice"), 1)
+        ]
+        self.bookmarks = [
+            {
+                "id": i,
+                "url": f"https://site{i % 97}.example.com/post/{i}",
+                "title": title(),
+                "description": body()[:400],
+                "notes": "",
+                "website_title": title(),
+                "website_description": body()[:400],
+                "is_archived": False,
+                "unread": False,
+                "shared": False,
+                "tag_names": rng.sample(WORDS, 2),
+                "date_added": stamp(i),
+                "date_modified": stamp(i + 1),
+                "favicon_url": None,
+            }
+            for i in range(size, 0, -1)
+        ]
+        self.documents = [
+            {
+                "id": i,
+                "correspondent": None,
+                "document_type": rng.choice([1, 2, 3, None]),
+                "storage_path": None,
+                "title": title(),
+                "content": body(),
+                "tags": rng.sample(range(1, len(WORDS) + 1), 2),
+                "created": stamp(i),
+                "modified": stamp(i + 1),
+                "added": stamp(i),
+                "archive_serial_number": None,
+                "original_file_name": f"scan-{i}.pdf",
+                "archived_file_name": f"{i:07}.pdf",
+                "notes": [],
+            }
+            for i in range(1, size + 1)
+        ]
+        self.entries = [
+            {
+                "id": i,
+                "url": f"https://news{i % 53}.example.org/article/{i}",
+                "title": title(),
+                "content": f"<p>{body()}</p>" * 3,
+                "tags": [{"id": 1, "label": rng.choice(WORDS), "slug": "tag"}],
+                "domain_name": f"news{i % 53}.example.org",
+                "created_at": stamp(i),
+                "updated_at": stamp(i + 1),
+                "is_archived": 0,
+                "is_starred": 0,
+                "reading_time": rng.randint(1, 20),
+            }
+            for i in range(1, size + 1)
+        ]
+
+
+class BenchHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes, don't let delayed ACKs stall every response
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.pause()
+        url = parse.urlsplit(self.path)
+        query = dict(parse.parse_qsl(url.query))
+        data = self.server.dataset
+        if url.path == "/_bench/bytes":
+            return self._send({"bytes": self.server.sent})
+        if url.path == "/api/bookmarks/":
+            return self._send(self._offset_page(data.bookmarks, query))
+        if url.path == "/api/tags/":
+            return self._send(self._numbered_page(data.tags, query))
+        if url.path == "/api/document_types/":
+            return self._send(self._numbered_page(data.document_types, query))
+        if url.path == "/api/documents/":
+            return self._send(self._documents(query))
+        if url.path == "/api/entries.json":
+            return self._send(self._entries(query))
+        self._send({"detail": "Not found."}, status=404)
+
+    def do_POST(self):
+        self.server.pause()
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path == "/oauth/v2/token":
+            return self._send({"access_token": "bench", "refresh_token": "bench", "expires_in": 3600})
+        self._send({"detail": "Not found."}, status=404)
+
+    def _documents(self, query: Dict[str, str]) -> Dict:
+        documents = self.server.dataset.documents
+        if "modified__gt" in query:
+            documents = [document for document in documents if document["modified"] > query["modified__gt"]]
+        if "id__in" in query:
+            ids = {int(doc_id) for doc_id in query["id__in"].split(",")}
+            documents = [document for document in documents if document["id"] in ids]
+        if "query" in query:
+            term = query["query"].lower()
+            documents = [document for document in documents if term in document["content"]]
+        if query.get("ordering") == "-modified":
+            documents = sorted(documents, key=lambda document: document["modified"], reverse=True)
+        page = self._numbered_page(documents, query)
+        if "fields" in query:
+            fields = query["fields"].split(",")
+            page["results"] = [
+                {field: document[field] for field in fields if field in document} for document in page["results"]
+            ]
+        return page
+
+    def _entries(self, query: Dict[str, str]) -> Dict:
+        entries = self.server.dataset.entries
+        if query.get("sort") == "updated":
+            entries = sorted(entries, key=lambda entry: entry["updated_at"], reverse=query.get("order") != "asc")
+        page = int(query.get("page", 1))
+        per_page = int(query.get("perPage", 30))
+        items = entries[(page - 1) * per_page:page * per_page]
+        if query.get("detail") == "metadata":
+            items = [{key: value for key, value in entry.items() if key != "content"} for entry in items]
+        return {
+            "page": page,
+            "limit": per_page,
+            "pages": max(1, -(-len(entries) // per_page)),
+            "total": len(entries),
+            "_links": {"self": {"href": self.path}},
+            "_embedded": {"items": items},
+        }
+
+    def _offset_page(self, items: List[Dict], query: Dict[str, str]) -> Dict:
+        offset = int(query.get("offset", 0))
+        limit = int(query.get("limit", 100))
+        next_url = None
+        if offset + limit < len(items):
+            next_url = self._link(query, offset=offset + limit, limit=limit)
+        return {"count": len(items), "next": next_url, "previous": None, "results": items[offset:offset + limit]}
+
+    def _numbered_page(self, items: List[Dict], query: Dict[str, str]) -> Dict:
+        page = int(query.get("page", 1))
+        size = int(query.get("page_size", 25))
+        next_url = None
+        if page * size < len(items):
+            next_url = self._link(query, page=page + 1)
+        result = {"count": len(items), "next": next_url, "previous": None}
+        if self.path.startswith("/api/documents/"):
+            result["all"] = [item["id"] for item in items]
+        result["results"] = items[(page - 1) * size:page * size]
+        return result
+
+    def _link(self, query: Dict[str, str], **changes) -> str:
+        host, port = self.server.server_address[:2]
+        path = parse.urlsplit(self.path).path
+        return f"http://{host}:{port}{path}?{parse.urlencode({**query, **changes})}"
+
+    def _send(self, payload: Dict, status: int = 200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count(len(body))
+
+
+class BenchServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, dataset: Dataset, latency: float = 0.0, address: Tuple[str, int] = ("127.0.0.1", 0)):
+        super().__init__(address, BenchHandler)
+        self.dataset = dataset
+        self.latency = latency
+        self.sent = 0
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def pause(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def count(self, sent: int):
+        with self._lock:
+            self.sent += sent
+
+    def start(self) -> "BenchServer":
+        threading.Thread(target=self.serve_forever, name="bench server", daemon=True).start()
+        return self
+
+
+def serve(size: int, latency: float = 0.0, port: Optional[int] = None) -> BenchServer:
+    return BenchServer(Dataset(size), latency, ("127.0.0.1", port or 0)).start()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+    server = serve(args.size, args.latency, args.port)
+    print(f"Serving {args.size} items per service on {server.base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
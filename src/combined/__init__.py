@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+"""Search linkding, wallabag and paperless at once.
+
+This extension doesn't talk to any service itself. It searches the caches of \
+the linkding, wallabag and paperless extensions, which have to be installed \
+and enabled, in parallel and merges their results into one list. Services \
+that haven't answered within the configured deadline are left out of that \
+query rather than holding up the others.
+
+Synopsis: all <query>"""
+
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from configparser import ConfigParser
+from typing import Any, List, Tuple
+
+from albert import *
+
+__title__ = "combined"
+__version__ = "0.1.0"
+__triggers__ = "all "
+__authors__ = "Pete Hamlin"
+
+iconPath = iconLookup("system-search") or iconLookup("edit-find")
+services = ("linkding", "wallabag", "paperless")
+
+
+def initialize():
+    global config
+    config_file = ConfigParser()
+    config_file.read(os.path.dirname(__file__) + "/config.ini")
+    config = Config(config_file["combined"])
+
+
+def handleQuery(query):
+    if query.isTriggered:
+        return show_results(query)
+
+
+def show_results(query) -> List[Item]:
+    providers = config.providers()
+    if not providers:
+        return [
+            Item(
+                id=__title__,
+                icon=iconPath,
+                text="No services to search",
+                subtext="Install and enable the {} extensions".format(", ".join(config.services)),
+            )
+        ]
+    completion = f"{__triggers__}{query.string}"
+    found = config.search(providers, query.string, lambda: query.isValid)
+    results = [provider.item(record, completion) for provider, record in found]
+    if not results:
+        loading = [name for name, provider in providers if provider.config.loading]
+        results.append(
+            Item(
+                id=__title__,
+                icon=iconPath,
+                text="Refreshing {}...".format(", ".join(loading)) if loading else "No results found",
+            )
+        )
+    return results
+
+
+class Config:
+    def __init__(self, config):
+        names = config.get("services", fallback=",".join(services)).split(",")
+        self.services = [name.strip() for name in names if name.strip()]
+        self.deadline = config.getfloat("deadline", fallback=0.3)
+        self.max_results = config.getint("max_results", fallback=50)
+        # One worker per service, a query never waits on a slow service twice
+        self.pool = ThreadPoolExecutor(max_workers=len(self.services) or 1, thread_name_prefix="combined search")
+        self._busy = set()
+        self._lock = threading.Lock()
+
+    def providers(self) -> List[Tuple[str, Any]]:
+        """The enabled services, as published by their extensions' initialize()."""
+        found = []
+        for name in self.services:
+            provider = sys.modules.get(f"albert_extensions.{name}")
+            if provider is None:
+                debug(f"{name} extension isn't loaded, leaving it out")
+            else:
+                found.append((name, provider))
+        return found
+
+    def search(self, providers: List[Tuple[str, Any]], query_string: str, is_current) -> List[Tuple[Any, Any]]:
+        """Search every provider in parallel and rank whatever arrived before the deadline."""
+        started = time.perf_counter()
+        futures = {}
+        for name, provider in providers:
+            future = self._submit(name, provider, query_string, is_current)
+            if future is not None:
+                futures[future] = (name, provider)
+        done, pending = wait(futures, timeout=self.deadline)
+        for future in pending:
+            debug(f"{futures[future][0]} missed the {self.deadline}s deadline for {query_string!r}")
+        ranked = []
+        for future in done:
+            name, provider = futures[future]
+            try:
+                records = future.result()
+            except Exception as exc:
+                warning(f"Searching {name} failed: {exc}")
+                continue
+            ranked.extend((rank, provider, record) for rank, record in enumerate(records))
+        ranked.sort(key=lambda entry: ranking(query_string, *entry))
+        debug(f"Combined search for {query_string!r} took {time.perf_counter() - started:.3f}s")
+        return [(provider, record) for _, provider, record in ranked[:self.max_results]]
+
+    def _submit(self, name: str, provider: Any, query_string: str, is_current):
+        with self._lock:
+            # A service still busy with an earlier keystroke is skipped rather than queued behind it
+            if name in self._busy:
+                return None
+            self._busy.add(name)
+
+        def run():
+            try:
+                return provider.search(query_string, is_current)
+            finally:
+                with self._lock:
+                    self._busy.discard(name)
+
+        return self.pool.submit(run)
+
+
+def ranking(query_string: str, rank: int, provider: Any, record: Any) -> Tuple:
+    """Sort key across services: title matches first, then each service's own order, newest first among equals."""
+    query = query_string.lower()
+    title = (getattr(record, "title", None) or "").lower()
+    if query and title.startswith(query):
+        tier = 0
+    elif all(word in title for word in query.split()):
+        tier = 1
+    else:
+        tier = 2
+    return tier, rank, -(provider.timestamp(record) or 0)
@@ -0,0 +1,1092 @@
+# -*- coding: utf-8 -*-
+
+"""Helpers shared by the linkding, paperless and wallabag extensions.
+
+Albert installs every extension on its own, so `make` copies this package
+into each installed extension as its `common` subpackage rather than
+installing it once. Each extension therefore gets its own copy of any state
+kept here, such as the `metrics` it reports from its `:stats` query."""
+
+import codecs
+import contextvars
+import heapq
+import itertools
+import json
+import os
+import queue
+import re
+import sys
+import tempfile
+import threading
+import time
+import types
+from collections import OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import requests
+import requests.adapters
+from albert import *
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def parse_timestamp(value: Optional[str]) -> float:
+    if not value:
+        return 0.0
+    try:
+        # fromisoformat() only learnt to read "Z" and "+0000" offsets in python 3.11
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        try:
+            return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S%z").timestamp()
+        except ValueError:
+            return 0.0
+
+
+def format_age(moment: Optional[datetime]) -> str:
+    if moment is None:
+        return "never"
+    minutes = int((datetime.now() - moment).total_seconds() // 60)
+    if minutes < 1:
+        return "just now"
+    if minutes < 120:
+        return f"{minutes} min ago"
+    return f"{minutes // 60} h ago"
+
+
+class SearchIndex:
+    """Trigram index over the searchable fields of a collection.
+
+    Built once per refresh so queries don't lowercase every field of every
+    record on each keystroke. A query is looked up by intersecting the posting
+    lists of its trigrams, and the surviving candidates are checked with a plain
+    substring test on the lowercased fields, so the matches are exactly the
+    ones a linear scan would return, in the same order. Queries shorter than a
+    trigram scan the pre-lowercased fields instead.
+
+    The matches for the last few queries are remembered, so when a query just
+    extends a previous one while typing, only the previous matches need to be
+    checked. Any change to the index forgets them.
+
+    With `fuzzy` set, a query without a single exact match is handed to a
+    `FuzzyIndex` instead, so typos still find something. Building that takes
+    seconds on a large collection, so queries never do it: after changing the
+    index, the mutating thread calls `rebuild_fuzzy`, and until then queries
+    keep using the previous one."""
+
+    gram_size = 3
+    cache_size = 32
+
+    def __init__(
+        self,
+        records: List[Any],
+        fields: Callable[[Any], List[str]],
+        timestamp: Callable[[Any], float] = lambda record: 0.0,
+        fuzzy: bool = False,
+    ):
+        self.records = list(records)
+        self.fields = fields
+        self.timestamp = timestamp
+        self.fuzzy = fuzzy
+        self._fuzzy_index = None
+        self._version = self._fuzzy_version = 0
+        self.haystacks = []
+        self.timestamps = []
+        postings = defaultdict(set)
+        for position, record in enumerate(records):
+            haystack = self._haystack(record)
+            self.haystacks.append(haystack)
+            self.timestamps.append(timestamp(record))
+            for gram in self._grams(haystack):
+                postings[gram].add(position)
+        self.postings = dict(postings)
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+        if fuzzy and self.records:
+            # Refreshes build the index off the query thread, so pay for this here
+            self._fuzzy_index = FuzzyIndex(self.haystacks)
+
+    def top(self, query_string: str, limit: int, within: Optional[set] = None) -> List[Any]:
+        """Return the best `limit` matches for a query, optionally only among the positions `within`.
+
+        Matches in earlier fields (the title) rank above matches in later ones,
+        then matches at the start of a word above ones inside a word, then
+        newer records above older ones."""
+        with self._lock:
+            if within is not None and not query_string:
+                positions = [position for position in within if self.records[position] is not None]
+            else:
+                positions = self.positions(query_string)
+            if within is not None:
+                positions = [position for position in positions if position in within]
+            elif not positions and self.fuzzy:
+                return self._fuzzy_top(query_string, limit)
+            best = heapq.nlargest(limit, positions, key=lambda position: self._score(query_string, position))
+            return [self.records[position] for position in best]
+
+    def _fuzzy_top(self, query_string: str, limit: int) -> List[Any]:
+        if self._fuzzy_index is None:
+            return []
+        # The fuzzy index may predate the last changes, skip records removed since
+        scores = self._fuzzy_index.scores(query_string)
+        positions = [position for position in scores if self.records[position] is not None]
+        best = heapq.nlargest(limit, positions, key=lambda position: (scores[position], self.timestamps[position]))
+        return [self.records[position] for position in best]
+
+    def rebuild_fuzzy(self):
+        """Bring the fuzzy index up to date after `add`, `update` or `remove`.
+
+        Runs on the caller's thread without holding up queries, which keep
+        using the previous fuzzy index until the new one is swapped in."""
+        with self._lock:
+            if not self.fuzzy or self._fuzzy_version == self._version:
+                return
+            version, haystacks = self._version, list(self.haystacks)
+        fuzzy_index = FuzzyIndex(haystacks)
+        with self._lock:
+            # Changed again meanwhile, that change's own rebuild will swap in
+            if version == self._version:
+                self._fuzzy_index, self._fuzzy_version = fuzzy_index, version
+
+    def positions(self, query_string: str) -> Tuple[int, ...]:
+        matches = self._recent.get(query_string)
+        metrics.count("query cache misses" if matches is None else "query cache hits")
+        if matches is None:
+            matches = self._match(query_string)
+            self._recent[query_string] = matches
+            if len(self._recent) > self.cache_size:
+                self._recent.popitem(last=False)
+        else:
+            self._recent.move_to_end(query_string)
+        return matches
+
+    def _match(self, query_string: str) -> Tuple[int, ...]:
+        for end in range(len(query_string) - 1, 0, -1):
+            # A query that extends an earlier one can only match a subset of it
+            previous = self._recent.get(query_string[:end])
+            if previous is not None:
+                return self._verify(query_string, previous)
+        if len(query_string) < self.gram_size:
+            candidates = (position for position, record in enumerate(self.records) if record is not None)
+        else:
+            grams = self._grams((query_string,))
+            if not all(gram in self.postings for gram in grams):
+                return ()
+            lists = sorted((self.postings[gram] for gram in grams), key=len)
+            candidates = set(lists[0])
+            for posting in lists[1:]:
+                candidates.intersection_update(posting)
+                if not candidates:
+                    return ()
+            candidates = sorted(candidates)
+        return self._verify(query_string, candidates)
+
+    def _verify(self, query_string: str, candidates) -> Tuple[int, ...]:
+        haystacks = self.haystacks
+        return tuple(
+            position for position in candidates
+            if any(query_string in field for field in haystacks[position])
+        )
+
+    def add(self, record: Any) -> int:
+        haystack = self._haystack(record)
+        with self._lock:
+            self._recent.clear()
+            self._version += 1
+            position = len(self.records)
+            self.records.append(record)
+            self.haystacks.append(haystack)
+            self.timestamps.append(self.timestamp(record))
+            for gram in self._grams(haystack):
+                self.postings.setdefault(gram, set()).add(position)
+        return position
+
+    def remove(self, position: int):
+        # Leave a tombstone so the positions of every other record stay valid
+        with self._lock:
+            self._recent.clear()
+            self._version += 1
+            for gram in self._grams(self.haystacks[position]):
+                self.postings[gram].discard(position)
+            self.records[position] = None
+            self.haystacks[position] = ()
+            self.timestamps[position] = 0.0
+
+    def update(self, position: int, record: Any):
+        haystack = self._haystack(record)
+        with self._lock:
+            self._recent.clear()
+            self._version += 1
+            for gram in self._grams(self.haystacks[position]) - self._grams(haystack):
+                self.postings[gram].discard(position)
+            for gram in self._grams(haystack):
+                self.postings.setdefault(gram, set()).add(position)
+            self.records[position] = record
+            self.haystacks[position] = haystack
+            self.timestamps[position] = self.timestamp(record)
+
+    def _score(self, query_string: str, position: int) -> Tuple[int, bool, float]:
+        for rank, field in enumerate(self.haystacks[position]):
+            start = field.find(query_string)
+            if start >= 0:
+                word_start = start == 0 or not field[start - 1].isalnum()
+                return -rank, word_start, self.timestamps[position]
+        return -len(self.haystacks[position]), False, self.timestamps[position]
+
+    def _haystack(self, record: Any) -> Tuple[str, ...]:
+        # Missing fields stay in place as empty strings, the score relies on
+        # each field keeping its position
+        return tuple(field.lower() if field else "" for field in self.fields(record))
+
+    @classmethod
+    def _grams(cls, fields) -> set:
+        size = cls.gram_size
+        return {field[i:i + size] for field in fields for i in range(len(field) - size + 1)}
+
+
+class FuzzyIndex:
+    """Typo tolerant matching over the words of a collection, scored with numpy.
+
+    Every distinct word is broken into its padded bigrams, all packed into
+    one flat array. Each query term is compared against the whole vocabulary
+    in a single vectorised pass (Dice coefficient of the bigram sets), then
+    the records that have a close enough word for every term are scored by
+    how close those words are.
+
+    Collecting those records is plain Python, so it's bounded per keystroke:
+    only the `max_words` closest words of each term are looked at, closest
+    first, and once `budget` seconds have passed the records scored so far
+    are returned, without checking the remaining terms."""
+
+    threshold = 0.5
+    min_term_length = 3
+    max_words = 64
+    budget = 0.05
+
+    def __init__(self, haystacks: List[Tuple[str, ...]]):
+        words = {}
+        self.postings = []
+        for position, haystack in enumerate(haystacks):
+            for word in set(self._words(" ".join(haystack))):
+                word_id = words.setdefault(word, len(words))
+                if word_id == len(self.postings):
+                    self.postings.append([])
+                self.postings[word_id].append(position)
+        self.grams = {}
+        gram_ids, offsets, counts = [], [], []
+        for word in words:
+            word_grams = self._grams(word)
+            offsets.append(len(gram_ids))
+            gram_ids.extend(self.grams.setdefault(gram, len(self.grams)) for gram in word_grams)
+            counts.append(len(word_grams))
+        self.gram_ids = numpy.array(gram_ids, dtype=numpy.int32)
+        self.offsets = numpy.array(offsets, dtype=numpy.int64)
+        self.counts = numpy.array(counts, dtype=numpy.float32)
+
+    def scores(self, query_string: str) -> Dict[int, float]:
+        terms = [term for term in self._words(query_string.lower()) if len(term) >= self.min_term_length]
+        if not terms or not len(self.offsets):
+            return {}
+        deadline = time.perf_counter() + self.budget
+        totals = None
+        for term in terms:
+            term_grams = self._grams(term)
+            known = [self.grams[gram] for gram in term_grams if gram in self.grams]
+            if not known:
+                return {}
+            wanted = numpy.zeros(len(self.grams), dtype=numpy.int32)
+            wanted[known] = 1
+            shared = numpy.add.reduceat(wanted[self.gram_ids], self.offsets)
+            closeness = 2 * shared / (self.counts + len(term_grams))
+            close = numpy.flatnonzero(closeness >= self.threshold)
+            close = close[numpy.argsort(-closeness[close], kind="stable")[:self.max_words]]
+            best = {}
+            out_of_time = False
+            for word_id in close:
+                if time.perf_counter() > deadline:
+                    metrics.count("fuzzy budget exceeded")
+                    out_of_time = True
+                    break
+                score = float(closeness[word_id])
+                for position in self.postings[word_id]:
+                    if best.get(position, 0.0) < score:
+                        best[position] = score
+            # Every term has to match, a record scores the sum of its closest words
+            totals = best if totals is None else {
+                position: totals[position] + score for position, score in best.items() if position in totals
+            }
+            if not totals or out_of_time:
+                return totals
+        return totals
+
+    @staticmethod
+    def _words(text: str) -> List[str]:
+        return re.findall(r"\w+", text)
+
+    @staticmethod
+    def _grams(word: str) -> set:
+        padded = f" {word} "
+        return {padded[i:i + 2] for i in range(len(padded) - 1)}
+
+
+def fuzzy_available() -> bool:
+    """Whether a `fuzzy` SearchIndex can be built, warning when it can't."""
+    if numpy is None:
+        warning("Fuzzy search needs numpy, falling back to exact matching")
+    return numpy is not None
+
+
+class HttpClient:
+    """Persistent HTTP session for talking to a single service.
+
+    Keeping one `requests.Session` around means paginated crawls and action
+    callbacks reuse warm keep-alive connections instead of opening a new
+    connection (and TLS handshake) per request. Authentication is configured
+    once on the session by the owner. Request latencies, counts and errors
+    go to `metrics`, so slow or failing instances show up in `:stats`."""
+
+    def __init__(self, user_agent: str, pool_size: int = 4, timeout: float = 5):
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({
+            "User-Agent": user_agent,
+            "Accept-Encoding": "gzip, deflate",
+        })
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def delete(self, url: str, **kwargs) -> requests.Response:
+        return self.request("DELETE", url, **kwargs)
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.RequestException:
+            self._record(time.perf_counter() - start, failed=True)
+            raise
+        elapsed = self._record(time.perf_counter() - start, failed=not response.ok)
+        debug(f"{method} {url} took {elapsed * 1000:.0f}ms")
+        if not kwargs.get("stream"):
+            # Streamed listings count their bytes as they're read
+            metrics.fetched(len(response.content))
+        return response
+
+    @staticmethod
+    def _record(elapsed: float, failed: bool) -> float:
+        metrics.record("http request", elapsed)
+        metrics.count("http requests")
+        if failed:
+            metrics.count("http errors")
+        return elapsed
+
+
+class ListingStream:
+    """Decodes a paginated JSON listing as it comes off the wire.
+
+    Only the array at `path` is walked, one element at a time, so a refresh
+    holds a single record and a network chunk rather than the whole decoded
+    page. Everything else at the top level ends up in `fields` once the
+    records have been consumed."""
+
+    chunk_size = 64 * 1024
+    _space = re.compile(r"[ \t\n\r]*")
+    _delimiters = (" ", "\t", "\n", "\r", ",", "]", "}")
+
+    def __init__(self, response: requests.Response, path: Tuple[str, ...]):
+        self.response = response
+        self.path = path
+        self.fields = {}
+        self._chunks = response.iter_content(self.chunk_size)
+        # JSON is always UTF-8, whatever requests guesses from the headers
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._json = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+        self._exhausted = False
+        self._decode_time = 0.0
+
+    def records(self, project: Callable[[Any], Any] = lambda value: value) -> Iterator[Any]:
+        """Yield the records at `path`, passed through `project` as soon as each is decoded.
+
+        Next to the time spent decoding and projecting, the whole page is timed
+        as "page": reading the body off the network included, the time the
+        caller spends on each record in between not."""
+        projection_time = page_time = 0.0
+        resumed = time.perf_counter()
+        try:
+            for value in self._object(self.path, self.fields):
+                start = time.perf_counter()
+                record = project(value)
+                end = time.perf_counter()
+                projection_time += end - start
+                page_time += end - resumed
+                resumed = None
+                yield record
+                resumed = time.perf_counter()
+            if self._peek():
+                raise ValueError("Trailing data after JSON listing")
+        finally:
+            if resumed is not None:
+                page_time += time.perf_counter() - resumed
+            self.response.close()
+            metrics.record("page", page_time)
+            metrics.record("decode", self._decode_time)
+            metrics.record("projection", projection_time)
+
+    def _object(self, path: Tuple[str, ...], fields: Optional[Dict]) -> Iterator[Any]:
+        self._expect("{")
+        while True:
+            char = self._peek()
+            if char == "}":
+                self._pos += 1
+                return
+            if char == ",":
+                self._pos += 1
+                continue
+            key = self._value()
+            self._expect(":")
+            if path and key == path[0]:
+                yield from self._array() if len(path) == 1 else self._object(path[1:], None)
+            else:
+                value = self._value()
+                if fields is not None:
+                    fields[key] = value
+
+    def _array(self) -> Iterator[Any]:
+        self._expect("[")
+        while True:
+            char = self._peek()
+            if char == "]":
+                self._pos += 1
+                return
+            if char == ",":
+                self._pos += 1
+                continue
+            yield self._value()
+
+    def _expect(self, char: str):
+        if self._peek() != char:
+            raise ValueError(f"Expected {char!r} in JSON listing")
+        self._pos += 1
+
+    def _peek(self) -> str:
+        while True:
+            self._pos = self._space.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer) or not self._fill():
+                return self._buffer[self._pos:self._pos + 1]
+
+    def _value(self) -> Any:
+        self._peek()
+        while True:
+            start = time.perf_counter()
+            try:
+                value, end = self._json.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                self._decode_time += time.perf_counter() - start
+                # Read at least as much again as is pending, so a large value
+                # isn't re-parsed from the start for every chunk
+                if not self._fill(len(self._buffer) - self._pos):
+                    raise
+                continue
+            # A number that runs into the end of the buffer, or that it cut short
+            # ("2." decodes as 2), may carry on in the next chunk
+            cut_short = self._buffer[end:end + 1] not in self._delimiters
+            if isinstance(value, (int, float)) and cut_short and self._fill():
+                continue
+            self._decode_time += time.perf_counter() - start
+            self._pos = end
+            return value
+
+    def _fill(self, minimum: int = 1) -> bool:
+        pending = [self._buffer[self._pos:]]
+        read = 0
+        while read < max(minimum, 1) and not self._exhausted:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self._exhausted = True
+                text = self._decoder.decode(b"", final=True)
+            else:
+                metrics.fetched(len(chunk))
+                text = self._decoder.decode(chunk)
+            pending.append(text)
+            read += len(text)
+        self._buffer = "".join(pending)
+        self._pos = 0
+        return read > 0
+
+
+def stream_page(http: "HttpClient", url: str, path: Tuple[str, ...] = ("results",)) -> ListingStream:
+    """GET one page of a listing and decode it as it comes in, see `ListingStream`."""
+    # Only waits for the headers, which HttpClient times, the body is timed as it's decoded
+    response = http.get(url, stream=True)
+    if not response.ok:
+        # Bail out rather than caching a partial crawl as the full set, the
+        # body is never read so hand the connection back to the pool first
+        debug(f"Got response {response} for {url}")
+        response.close()
+        response.raise_for_status()
+    return ListingStream(response, path)
+
+
+def stream_records(
+    http: "HttpClient",
+    url: str,
+    project: Callable[[Any], Any] = lambda value: value,
+    path: Tuple[str, ...] = ("results",),
+    next_url: Callable[[Dict], Optional[str]] = lambda fields: fields["next"],
+) -> Iterator[Any]:
+    """Yield every record of a paginated listing, projected as soon as it's decoded.
+
+    `next_url` picks the following page out of the fields around the records,
+    by default the `next` link linkding and paperless send."""
+    while url:
+        page = stream_page(http, url, path)
+        yield from page.records(project)
+        url = next_url(page.fields)
+
+
+class AdaptiveTtl:
+    """Refresh interval that follows how often a collection actually changes.
+
+    Every refresh that finds changes halves the interval and every one that
+    doesn't grows it by half, always within `minimum` and `maximum`."""
+
+    def __init__(self, initial: timedelta, minimum: timedelta, maximum: timedelta):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.current = min(self.maximum, max(self.minimum, initial))
+
+    def changed(self) -> timedelta:
+        self.current = max(self.minimum, self.current / 2)
+        return self.current
+
+    def unchanged(self) -> timedelta:
+        self.current = min(self.maximum, self.current * 1.5)
+        return self.current
+
+
+class ChangeProbe:
+    """Cheap check for whether a collection changed since the last refresh.
+
+    The probe URL should return a small listing whose fingerprint changes
+    along with the collection (e.g. the count and the newest entry). The
+    validators the server handed out last time are sent along so it can
+    answer with a bare 304. A new fingerprint only counts once `confirm()`
+    is called after a successful refresh, and a full refresh is asked for
+    at least every `max_age` regardless."""
+
+    def __init__(self, http: "HttpClient", max_age: timedelta = timedelta(hours=24)):
+        self.http = http
+        self.max_age = max_age
+        self.confirmed_at = None
+        self.fingerprint = None
+        self.validators = {}
+        self._pending = None
+
+    def changed(self, url: str, fingerprint: Callable[[Dict], Any]) -> bool:
+        debug("About to GET {}".format(url))
+        response = self.http.get(url, headers=self.validators)
+        if response.status_code == 304:
+            self._pending = None
+            return self._overdue()
+        if not response.ok:
+            debug("Got response {}".format(response))
+            response.raise_for_status()
+        validators = {}
+        if "ETag" in response.headers:
+            validators["If-None-Match"] = response.headers["ETag"]
+        if "Last-Modified" in response.headers:
+            validators["If-Modified-Since"] = response.headers["Last-Modified"]
+        current = fingerprint(response.json())
+        self._pending = (current, validators)
+        return current != self.fingerprint or self._overdue()
+
+    def confirm(self):
+        if self._pending:
+            self.fingerprint, self.validators = self._pending
+            self._pending = None
+        self.confirmed_at = datetime.now()
+
+    def _overdue(self) -> bool:
+        return self.confirmed_at is None or datetime.now() - self.confirmed_at > self.max_age
+
+
+class BackgroundRefresh:
+    """Runs a refresh on a worker thread so queries never wait on the API.
+
+    Only one refresh is in flight at a time: triggering while a crawl is
+    already running is a no-op, so a burst of keystrokes past the expiry
+    results in a single crawl. The refresh is expected to build its result
+    locally and swap it in with a single assignment once complete, so readers
+    always see either the old snapshot or the new one.
+
+    Outcomes are reported to the service's circuit breaker, and no refresh is
+    started while the breaker is backing off."""
+
+    def __init__(self, name: str, target: Callable[[], None], breaker: "CircuitBreaker"):
+        self.name = name
+        self.target = target
+        self.breaker = breaker
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def trigger(self) -> bool:
+        if not self.breaker.allow():
+            return False
+        with self._lock:
+            if self.running:
+                return False
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+            return True
+
+    def run(self):
+        """Refresh on the calling thread, with the same back-off rules."""
+        if self.breaker.allow():
+            self._run()
+
+    def _run(self):
+        start = time.perf_counter()
+        # Bytes and notes of this run only, other refreshers may be running alongside
+        details = {"bytes": 0}
+        token = refresh_details.set(details)
+        try:
+            self.target()
+        except Exception as err:
+            warning(f"{self.name} failed: {err}")
+            self.breaker.failure()
+            metrics.refreshed(self.name, time.perf_counter() - start, details, err)
+        else:
+            self.breaker.success()
+            metrics.refreshed(self.name, time.perf_counter() - start, details)
+        finally:
+            refresh_details.reset(token)
+
+
+class CircuitBreaker:
+    """Backs off from a service after failed requests.
+
+    Every consecutive failure doubles the wait before the service is tried
+    again (up to `max_delay`), so an unreachable instance costs one timeout per
+    back-off period rather than one per keystroke. Meanwhile the breaker is
+    open and queries keep being answered from the last good data. The first
+    success closes it again."""
+
+    def __init__(self, base_delay: timedelta = timedelta(seconds=15), max_delay: timedelta = timedelta(minutes=30)):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failures = 0
+        self.retry_at = datetime.now()
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.failures > 0
+
+    def allow(self) -> bool:
+        return datetime.now() >= self.retry_at
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.retry_at = datetime.now()
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            delay = min(self.base_delay * 2 ** (self.failures - 1), self.max_delay)
+            self.retry_at = datetime.now() + delay
+        debug(f"Backing off for {delay.total_seconds():.0f}s after {self.failures} failures")
+
+    def reset(self):
+        with self._lock:
+            self.retry_at = datetime.now()
+
+
+class IconCache:
+    """Disk-backed cache of per-item icons, filled by background workers.
+
+    Looking an icon up never touches the network: until an icon has been
+    fetched the extension icon is used instead and the icon is queued. Icons
+    of items that were just shown jump the queue ahead of anything prefetched
+    after a refresh. Icons that fail to download aren't retried until albert
+    restarts, and the least recently used ones are evicted once the cache
+    grows past `max_bytes`."""
+
+    workers = 3
+    prefetch_limit = 200
+    max_icon_bytes = 256 * 1024
+    extensions = {
+        "image/png": ".png",
+        "image/jpeg": ".jpg",
+        "image/webp": ".webp",
+        "image/gif": ".gif",
+        "image/svg+xml": ".svg",
+        "image/x-icon": ".ico",
+        "image/vnd.microsoft.icon": ".ico",
+    }
+
+    def __init__(self, name: str, http: "HttpClient", max_bytes: int, fallback: str):
+        self.path = os.path.join(cacheLocation(), name, "icons")
+        self.http = http
+        self.max_bytes = max_bytes
+        self.fallback = fallback
+        self._paths = {}
+        self._used = {}
+        self._failed = set()
+        self._queued = {}
+        self._queue = queue.PriorityQueue()
+        self._counter = itertools.count()
+        self._threads = []
+        self._lock = threading.Lock()
+        if os.path.isdir(self.path):
+            for filename in os.listdir(self.path):
+                key, extension = os.path.splitext(filename)
+                if extension != ".tmp":
+                    self._paths[key] = os.path.join(self.path, filename)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, key: str, url: str) -> str:
+        """Return the cached icon for `key`, queueing it from `url` if needed."""
+        path = self._paths.get(key)
+        metrics.count("icon cache hits" if path else "icon cache misses")
+        if path:
+            self._used[key] = time.time()
+            return path
+        if self.enabled:
+            # Shown items go ahead of prefetches, most recently shown first
+            self._enqueue(-next(self._counter), key, url)
+        return self.fallback
+
+    def prefetch(self, icons: Dict[str, str]):
+        if not self.enabled:
+            return
+        for key, url in itertools.islice(icons.items(), self.prefetch_limit):
+            if key not in self._paths:
+                self._enqueue(next(self._counter), key, url)
+
+    def _enqueue(self, priority: int, key: str, url: str):
+        with self._lock:
+            if key in self._failed or self._queued.get(key, priority + 1) <= priority:
+                return
+            self._queued[key] = priority
+            self._queue.put((priority, key, url))
+            if len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, name="icon fetch", daemon=True)
+                self._threads.append(thread)
+                thread.start()
+
+    def _work(self):
+        while True:
+            priority, key, url = self._queue.get()
+            with self._lock:
+                # Skip stale entries left behind when an icon was requeued
+                if self._queued.get(key) != priority:
+                    continue
+            try:
+                self._fetch(key, url)
+            except (requests.RequestException, OSError) as err:
+                debug(f"Could not fetch icon {url}: {err}")
+                self._failed.add(key)
+            finally:
+                with self._lock:
+                    self._queued.pop(key, None)
+
+    def _fetch(self, key: str, url: str):
+        if key in self._paths:
+            return
+        response = self.http.get(url)
+        content_type = response.headers.get("Content-Type", "").split(";")[0].strip()
+        if not response.ok or content_type not in self.extensions or len(response.content) > self.max_icon_bytes:
+            self._failed.add(key)
+            return
+        os.makedirs(self.path, exist_ok=True)
+        path = os.path.join(self.path, key + self.extensions[content_type])
+        with open(f"{path}.tmp", "wb") as icon_file:
+            icon_file.write(response.content)
+        os.replace(f"{path}.tmp", path)
+        self._paths[key] = path
+        self._used[key] = time.time()
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            for key, path in list(self._paths.items()):
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    self._paths.pop(key, None)
+                    continue
+                entries.append((max(stat.st_mtime, self._used.get(key, 0)), stat.st_size, key, path))
+            total = sum(size for _, size, _, _ in entries)
+            for _, size, key, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                self._paths.pop(key, None)
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+
+
+class Record:
+    """Base for the compact records an extension caches in place of API payloads.
+
+    Subclasses list their fields in `__slots__`. Snapshots store a record as
+    the row of those values in order, so `cls(*row)` restores it."""
+
+    __slots__ = ()
+
+    def to_row(self) -> List[Any]:
+        return [getattr(self, name) for name in self.__slots__]
+
+
+class SnapshotStore:
+    """Versioned on-disk copy of the last successful refresh.
+
+    Lets queries be answered straight after an albert restart, while the usual
+    expiry logic decides when the snapshot needs revalidating against the API.
+    Snapshots written by another schema version, or that fail to parse, are
+    discarded and the extension falls back to a full refresh."""
+
+    def __init__(self, name: str, collection: str, version: int):
+        self.path = os.path.join(cacheLocation(), name, f"{collection}.json")
+        self.version = version
+
+    def load(self, decode: Callable[[Any], Any] = lambda data: data) -> Optional[Tuple[Any, datetime]]:
+        try:
+            with open(self.path, "r") as snapshot_file:
+                snapshot = json.load(snapshot_file)
+            if snapshot.get("version") != self.version:
+                debug(f"Ignoring snapshot with schema version {snapshot.get('version')}")
+                return None
+            return decode(snapshot["data"]), datetime.fromisoformat(snapshot["synced"])
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as err:
+            warning(f"Discarding unreadable snapshot {self.path}: {err}")
+            self.clear()
+            return None
+
+    def save(self, data: Any, synced: Optional[datetime] = None):
+        """Write `data` as last synced with the server at `synced`, by default now."""
+        synced = synced or datetime.now()
+        snapshot = {"version": self.version, "synced": synced.isoformat(), "data": data}
+        try:
+            directory = os.path.dirname(self.path)
+            os.makedirs(directory, exist_ok=True)
+            # A temporary file of its own, a refresh and a local edit may save at the same time
+            fd, tmp_path = tempfile.mkstemp(prefix=f"{os.path.basename(self.path)}.", suffix=".tmp", dir=directory)
+            try:
+                with os.fdopen(fd, "w") as snapshot_file:
+                    json.dump(snapshot, snapshot_file, separators=(",", ":"))
+                os.replace(tmp_path, self.path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        except OSError as err:
+            warning(f"Could not write snapshot {self.path}: {err}")
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class Metrics:
+    """Rolling timings and counters behind the `:stats` query.
+
+    Each phase keeps its last `window` samples, so percentiles follow recent
+    behaviour without growing for as long as albert runs. Counters only ever
+    go up. The details of the most recent refresh are kept separately, the
+    refresh itself adds whatever it knows about via `note()`. Those and the
+    bytes it fetched are collected in `refresh_details`, which each run of a
+    `BackgroundRefresh` sets for its own context."""
+
+    def __init__(self, window: int = 500):
+        self.timings = defaultdict(lambda: deque(maxlen=window))
+        self.counters = defaultdict(int)
+        self.last_refresh = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timed(self, phase: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(phase, time.perf_counter() - start)
+
+    def record(self, phase: str, elapsed: float):
+        with self._lock:
+            self.timings[phase].append(elapsed)
+
+    def count(self, counter: str, amount: int = 1):
+        with self._lock:
+            self.counters[counter] += amount
+
+    def fetched(self, amount: int):
+        details = refresh_details.get()
+        with self._lock:
+            self.counters["bytes fetched"] += amount
+            if details is not None:
+                details["bytes"] += amount
+
+    def note(self, **details):
+        # Outside a refresh there is nothing to attach the details to
+        run = refresh_details.get()
+        if run is not None:
+            with self._lock:
+                run.update(details)
+
+    def refreshed(self, name: str, elapsed: float, details: Dict, error: Optional[Exception] = None):
+        with self._lock:
+            self.timings["refresh"].append(elapsed)
+            self.last_refresh = {
+                "name": name,
+                "finished": datetime.now().isoformat(timespec="seconds"),
+                "seconds": round(elapsed, 3),
+                "error": str(error) if error else None,
+                **details,
+            }
+
+    def percentiles(self, phase: str) -> Tuple[int, float, float]:
+        with self._lock:
+            samples = sorted(self.timings[phase])
+        if not samples:
+            return 0, 0.0, 0.0
+        return len(samples), samples[len(samples) // 2], samples[min(len(samples) - 1, len(samples) * 95 // 100)]
+
+    def snapshot(self) -> Dict:
+        phases = {}
+        for phase in sorted(self.timings):
+            samples, p50, p95 = self.percentiles(phase)
+            phases[phase] = {"samples": samples, "p50": p50, "p95": p95}
+        with self._lock:
+            return {
+                "time": datetime.now().isoformat(timespec="seconds"),
+                "timings": phases,
+                "counters": dict(self.counters),
+                "last_refresh": dict(self.last_refresh),
+            }
+
+    def dump(self, path: str):
+        """Append the current numbers to a JSON lines file, one line per dump."""
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "a") as stats_file:
+                stats_file.write(json.dumps(self.snapshot()) + "\n")
+        except OSError as err:
+            warning(f"Could not write stats to {path}: {err}")
+
+
+metrics = Metrics()
+refresh_details = contextvars.ContextVar("refresh_details", default=None)
+# Reserved query showing timings and counters instead of results
+stats_query = ":stats"
+
+
+def offline_item(title: str, icon: str, service: str, collection: str, config: Any) -> Item:
+    """Heads the cached results while `service` can't be reached.
+
+    `config` is the extension's config, for its last sync time, base URL and
+    `retry()`."""
+    return Item(
+        id=title,
+        icon=icon,
+        text=f"{service} is unreachable",
+        subtext=f"Showing {collection} last synced {format_age(config.synced)}",
+        actions=[
+            FuncAction(text="Retry now", callable=config.retry),
+            UrlAction(text=f"Open {service}", url=config.base_url),
+        ],
+    )
+
+
+def stats_items(name: str, title: str, icon: str) -> List[Item]:
+    """The `:stats` query: timings, counters and the last refresh as items."""
+    stats = metrics.snapshot()
+    stats_path = os.path.join(cacheLocation(), name, "stats.jsonl")
+    results = [
+        Item(
+            id=title,
+            icon=icon,
+            text=f"{phase}: p50 {timing['p50'] * 1000:.1f}ms, p95 {timing['p95'] * 1000:.1f}ms",
+            subtext=f"Over the last {timing['samples']} samples",
+        )
+        for phase, timing in stats["timings"].items()
+    ]
+    refresh = stats["last_refresh"]
+    if refresh:
+        details = ", ".join(
+            f"{key} {value}"
+            for key, value in refresh.items()
+            if key not in ("name", "finished") and value is not None
+        )
+        text = f"Last refresh: {refresh['name']} at {refresh['finished']}"
+        results.insert(0, Item(id=title, icon=icon, text=text, subtext=details))
+    if stats["counters"]:
+        counters = ", ".join(f"{counter} {value}" for counter, value in sorted(stats["counters"].items()))
+        results.append(Item(id=title, icon=icon, text="Counters", subtext=counters))
+    results.append(
+        Item(
+            id=title,
+            icon=icon,
+            text="Save stats",
+            subtext=f"Append these numbers to {stats_path}",
+            actions=[
+                FuncAction(text="Save stats", callable=lambda: metrics.dump(stats_path)),
+                ClipAction(text="Copy stats as JSON", clipboardText=json.dumps(stats, indent=2)),
+            ],
+        )
+    )
+    return results
+
+
+def start_warm_up(name: str, target: Callable[[], None]):
+    """Run an extension's warm-up on a thread of its own.
+
+    initialize() runs on albert's startup path, so it only reads the config.
+    Loading snapshots and triggering the first refreshes happen in `target`."""
+    threading.Thread(target=target, name=name, daemon=True).start()
+
+
+def publish_provider(
+    name: str,
+    config: Any,
+    search: Callable[[str, Callable[[], bool]], List[Any]],
+    item: Callable[[Any, str], Item],
+    timestamp: Callable[[Any], float],
+):
+    """Make an extension's cache searchable from the combined extension.
+
+    albert doesn't keep extension modules in sys.modules, so what the combined
+    search needs is published there instead, as `albert_extensions.<name>`.
+    `search` takes the query string and whether the query is still current."""
+    sys.modules[f"albert_extensions.{name}"] = types.SimpleNamespace(
+        config=config, search=search, item=item, timestamp=timestamp
+    )
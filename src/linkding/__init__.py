@@ -6,15 +6,51 @@ extension not working correctly.
 
 Synopsis: ld <query>"""
 
+import importlib.util
 import os
+import sys
+import threading
 from configparser import ConfigParser
 from datetime import datetime, timedelta
-from typing import Dict, List, Tuple
+from typing import Callable, Dict, List, Optional, Tuple
 from urllib import parse
 
 import requests
 from albert import *
 
+
+def _load_common(name: str):
+    # albert runs an extension from its file without registering it in sys.modules, so a
+    # relative import of the bundled common package has no parent to resolve against
+    path = os.path.join(os.path.dirname(__file__), "common", "__init__.py")
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+
+
+_load_common("albert_extensions.linkding.common")
+from albert_extensions.linkding.common import (
+    AdaptiveTtl,
+    BackgroundRefresh,
+    ChangeProbe,
+    CircuitBreaker,
+    HttpClient,
+    IconCache,
+    Record,
+    SearchIndex,
+    SnapshotStore,
+    fuzzy_available,
+    metrics,
+    offline_item,
+    parse_timestamp,
+    publish_provider,
+    start_warm_up,
+    stats_items,
+    stats_query,
+    stream_records,
+)
+
 __title__ = "Linkding"
 __version__ = "0.1.1"
 __triggers__ = "ld "
@@ -22,6 +58,9 @@ __authors__ = "Pete Hamlin"
 
 iconPath = iconLookup("linkding") or os.path.dirname(__file__) + "/linkding.png"
 user_agent = "org.albert.extension.python.linkding"
+snapshot_version = 2
+# Bookmarks the change probe asks for, on top of the total count
+probe_size = 10
 
 
 def initialize():
@@ -29,89 +68,89 @@ def initialize():
     config_file = ConfigParser()
     config_file.read(os.path.dirname(__file__) + "/config.ini")
     config = ApiConfig(config_file["linkding"])
+    publish_provider(
+        "linkding",
+        config,
+        lambda query_string, is_current: config.search_articles(query_string),
+        article_item,
+        article_timestamp,
+    )
 
 
 def handleQuery(query):
     if query.isTriggered:
+        if query.string.strip() == stats_query:
+            return stats_items("linkding", __title__, iconPath)
         return show_articles(query)
 
 
 def show_articles(query) -> List[Item]:
     results = []
-    for article in config.get_articles():
-        article_id, title, article_url = article["id"], article["title"], article["url"]
-        link_id = article["id"]
-        tags = ", ".join([tag for tag in article["tag_names"]])
-        if filter_query(query.string, [title, tags, article_url]):
-            debug(f"Got article: {title} - query string {query.string}")
-            subtext = "{}: {}".format(tags, article_url)
-            results.append(
-                Item(
-                    id=__title__,
-                    icon=iconPath,
-                    text=title or article["website_title"] or article_url,
-                    subtext=subtext,
-                    completion=f"{__triggers__} {query.string}",
-                    actions=[
-                        UrlAction(text="Open link in browser", url=article_url),
-                        ClipAction(text="Copy link URL", clipboardText=article_url),
-                        FuncAction(
-                            text="Archive link",
-                            callable=lambda link_id=article_id: archive_link(link_id),
-                        ),
-                        FuncAction(
-                            text="Delete link",
-                            callable=lambda link_id=article_id: delete_link(link_id),
-                        ),
-                    ],
-                )
-            )
+    articles = config.search_articles(query.string)
+    with metrics.timed("items"):
+        for article in articles:
+            debug(f"Got article: {article.title} - query string {query.string}")
+            results.append(article_item(article, f"{__triggers__} {query.string}"))
+    metrics.count("items shown", len(results))
     if not results:
         results.append(
             Item(
                 id=__title__,
                 icon=iconPath,
-                text="No articles found",
+                text="Refreshing articles..." if config.loading else "No articles found",
                 actions=[
                     UrlAction(text="Open linkding", url=config.base_url),
                     FuncAction(
-                        text="Refresh Articles", callable=config.refresh_articles
+                        text="Refresh Articles", callable=config.refresher.trigger
                     ),
                 ],
             )
         ),
+    if config.breaker.is_open:
+        results.insert(0, offline_item(__title__, iconPath, "linkding", "bookmarks", config))
     return results
 
 
-def filter_query(query_string: str, filters: List[str]) -> bool:
-    for item in filters:
-        if query_string in item.lower():
-            return True
-    return False
+def article_item(article: "Bookmark", completion: str) -> Item:
+    article_id, title, article_url = article.id, article.title, article.url
+    return Item(
+        id=__title__,
+        icon=config.icons.get(*article_icon(article)),
+        text=title or article_url,
+        subtext="{}: {}".format(article.tags, article_url),
+        completion=completion,
+        actions=[
+            UrlAction(text="Open link in browser", url=article_url),
+            ClipAction(text="Copy link URL", clipboardText=article_url),
+            FuncAction(
+                text="Archive link",
+                callable=lambda link_id=article_id: archive_link(link_id),
+            ),
+            FuncAction(
+                text="Delete link",
+                callable=lambda link_id=article_id: delete_link(link_id),
+            ),
+        ],
+    )
 
 
 def delete_link(link_id: str):
     url = f"{config.base_url}/api/bookmarks/{link_id}"
-    debug("About to DELETE {}".format(url))
-    response = requests.delete(url, headers=config.headers)
-    if response.ok:
-        config.refresh_articles()
-    else:
-        warn("Got response {}".format(response))
+    config.drop_article(link_id, lambda: send_request("DELETE", url))
 
 
 def archive_link(link_id: str):
+    # Archived bookmarks aren't part of the listing we cache
     url = f"{config.base_url}/api/bookmarks/{link_id}/archive/"
-    post_request(url)
+    config.drop_article(link_id, lambda: send_request("POST", url))
 
 
-def post_request(url: str):
-    debug("About to POST {}".format(url))
-    response = requests.post(url, headers=config.headers)
-    if response.ok and response.content:
-        return response.json()
-    else:
-        warn("Got response {}".format(response))
+def send_request(method: str, url: str) -> bool:
+    debug("About to {} {}".format(method, url))
+    response = config.http.request(method, url)
+    if not response.ok:
+        warning("Got response {}".format(response))
+    return response.ok
 
 
 class ApiConfig:
@@ -119,38 +158,180 @@ class ApiConfig:
         self.api_token = config["api_token"]
         self.base_url = config["base_url"]
         self.per_page = config["results_per_page"]
-        self.headers = {
-            "Authorization": "Token {}".format(self.api_token),
-        }
+        self.max_results = config.getint("max_results", fallback=50)
+        self.fuzzy = config.getboolean("fuzzy", fallback=False) and fuzzy_available()
+        # Favicons come from the bookmarked sites, keep the API token away from them
+        icon_cache_size = config.getint("icon_cache_size", fallback=20) * 1024 * 1024
+        self.icons = IconCache("linkding", HttpClient(user_agent), icon_cache_size, iconPath)
+        self.http = HttpClient(user_agent)
+        self.http.session.headers["Authorization"] = "Token {}".format(self.api_token)
         self.params = {
             "limit": self.per_page,
         }
         self.articles = []
+        self.index = SearchIndex([], article_fields, article_timestamp, self.fuzzy)
         self.article_expiry = datetime.now()
+        self.article_ttl = AdaptiveTtl(
+            timedelta(minutes=30),
+            timedelta(minutes=config.getint("min_ttl", fallback=5)),
+            timedelta(minutes=config.getint("max_ttl", fallback=120)),
+        )
+        self.probe = ChangeProbe(self.http)
+        self.synced = None
+        self.store = SnapshotStore("linkding", "articles", snapshot_version)
+        self.breaker = CircuitBreaker()
+        self.refresher = BackgroundRefresh("linkding refresh", self.refresh_articles, self.breaker)
+        self.ready = threading.Event()
+        start_warm_up("linkding warm-up", self._warm_up)
 
-    def get_articles(self) -> List[Dict]:
-        if self.article_expiry < datetime.now():
-            self.refresh_articles()
-        return self.articles
+    @property
+    def loading(self) -> bool:
+        return not self.ready.is_set() or self.refresher.running
+
+    def search_articles(self, query_string: str) -> List["Bookmark"]:
+        if self.ready.is_set() and self.article_expiry < datetime.now():
+            self.refresher.trigger()
+        with metrics.timed("filter"):
+            return self.index.top(query_string, self.max_results)
+
+    def retry(self):
+        self.breaker.reset()
+        self.refresher.trigger()
+
+    def drop_article(self, article_id: int, request: Callable[[], bool]):
+        """Remove an article from the cache straight away, then send `request`.
+
+        The request runs on a worker thread so the action returns immediately.
+        If it fails the article is put back, otherwise the change is persisted
+        and the next refresh reconciles with the server as usual."""
+        removed = self._remove_article(article_id)
+
+        def send():
+            try:
+                done = request()
+            except requests.RequestException as err:
+                warning(f"Request for bookmark {article_id} failed: {err}")
+                done = False
+            if done:
+                # A local edit, the rest of the snapshot is still only as fresh as the last refresh
+                self.store.save([article.to_row() for article in self.articles], self.synced)
+            elif removed:
+                self._restore_article(*removed)
+            if removed:
+                removed[0].rebuild_fuzzy()
+
+        threading.Thread(target=send, name="linkding action", daemon=True).start()
+
+    def _remove_article(self, article_id: int) -> Optional[Tuple["SearchIndex", int, int, "Bookmark"]]:
+        index = self.index
+        for position, article in enumerate(index.records):
+            if article is not None and article.id == article_id:
+                break
+        else:
+            return None
+        index.remove(position)
+        articles = self.articles
+        list_position = articles.index(article)
+        self.articles = articles[:list_position] + articles[list_position + 1:]
+        return index, position, list_position, article
+
+    def _restore_article(self, index: "SearchIndex", position: int, list_position: int, article: "Bookmark"):
+        if index is not self.index:
+            # A refresh has replaced the snapshot since, it already has the article
+            return
+        index.update(position, article)
+        articles = self.articles
+        self.articles = articles[:list_position] + [article] + articles[list_position:]
+        debug(f"Restored bookmark {article.id}")
+
+    def _set_articles(self, articles: List["Bookmark"]):
+        # Build the index before publishing so readers never see a mismatched pair
+        self.index = SearchIndex(articles, article_fields, article_timestamp, self.fuzzy)
+        self.articles = articles
+        self.icons.prefetch(dict(article_icon(article) for article in articles))
 
     def refresh_articles(self):
         url = f"{self.base_url}/api/bookmarks/?{self._get_params()}"
+        probe_url = f"{self.base_url}/api/bookmarks/?limit={probe_size}"
+        if not self.probe.changed(probe_url, listing_fingerprint):
+            self.synced = datetime.now()
+            self.article_expiry = self.synced + self.article_ttl.unchanged()
+            debug("Bookmarks unchanged, next check in {}".format(self.article_ttl.current))
+            metrics.note(changed=False, next_check=str(self.article_ttl.current))
+            return
         debug("About to GET {}".format(url))
-        articles = []
-        while url:
-            results, url = self._parse_results(url)
-            articles += results
-        self.articles = articles
-        self.article_expiry = datetime.now() + timedelta(minutes=30)
+        articles = list(stream_records(self.http, url, Bookmark.from_api))
+        self._set_articles(articles)
+        self.probe.confirm()
+        self.synced = datetime.now()
+        self.article_expiry = self.synced + self.article_ttl.changed()
+        self.store.save([article.to_row() for article in articles])
+        metrics.note(changed=True, records=len(articles), next_check=str(self.article_ttl.current))
 
-    def _parse_results(self, url) -> Tuple[List[Dict], str]:
-        response = requests.get(url, headers=self.headers, timeout=5)
-        if response.ok:
-            result = response.json()
-            return result["results"], result["next"]
-        else:
-            debug("Got response {}".format(response))
-            return [], ""
+    def _warm_up(self):
+        try:
+            self._load_snapshot()
+        finally:
+            self.ready.set()
+        if self.article_expiry < datetime.now():
+            self.refresher.trigger()
+
+    def _load_snapshot(self):
+        snapshot = self.store.load(lambda rows: [Bookmark(*row) for row in rows])
+        if snapshot:
+            articles, self.synced = snapshot
+            self._set_articles(articles)
+            self.article_expiry = self.synced + self.article_ttl.current
+            debug(f"Loaded {len(self.articles)} articles from snapshot")
 
     def _get_params(self):
         return "&".join(f"{key}={value}" for key, value in self.params.items())
+
+
+class Bookmark(Record):
+    """The parts of a linkding bookmark the extension actually uses.
+
+    Descriptions and the scraped website metadata are dropped as soon as a
+    page is parsed, the website title only survives as a stand-in for a
+    missing title."""
+
+    __slots__ = ("id", "url", "title", "tags", "added", "favicon_url")
+
+    def __init__(self, id: int, url: str, title: str, tags: str, added: float, favicon_url: Optional[str]):
+        self.id = id
+        self.url = url
+        self.title = title
+        self.tags = tags
+        self.added = added
+        self.favicon_url = favicon_url
+
+    @classmethod
+    def from_api(cls, bookmark: Dict) -> "Bookmark":
+        return cls(
+            bookmark["id"],
+            bookmark["url"],
+            bookmark["title"] or bookmark.get("website_title") or "",
+            ", ".join(bookmark["tag_names"]),
+            parse_timestamp(bookmark.get("date_added")),
+            bookmark.get("favicon_url"),
+        )
+
+
+def listing_fingerprint(result: Dict) -> Tuple:
+    # linkding lists the newest bookmarks first and can't sort by modification time, so
+    # edits to older ones are only picked up by the full refresh ChangeProbe forces daily
+    return result["count"], [(bookmark["id"], bookmark.get("date_modified")) for bookmark in result["results"]]
+
+
+def article_fields(article: Bookmark) -> List[str]:
+    return [article.title, article.tags, article.url]
+
+
+def article_icon(article: Bookmark) -> Tuple[str, str]:
+    url = parse.urlsplit(article.url)
+    # Newer linkding versions serve the favicons they've already fetched
+    return url.netloc, article.favicon_url or f"{url.scheme}://{url.netloc}/favicon.ico"
+
+
+def article_timestamp(article: Bookmark) -> float:
+    return article.added
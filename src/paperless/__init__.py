@@ -6,15 +6,56 @@ extension not working correctly.
 
 Synopsis: pl <query>"""
 
+import importlib.util
 import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from collections import OrderedDict, defaultdict
 from configparser import ConfigParser
 from datetime import datetime, timedelta
-from typing import Dict, List, Tuple
+from typing import Callable, Dict, List, Optional, Tuple
 from urllib import parse
 
 import requests
 from albert import *
 
+
+def _load_common(name: str):
+    # albert runs an extension from its file without registering it in sys.modules, so a
+    # relative import of the bundled common package has no parent to resolve against
+    path = os.path.join(os.path.dirname(__file__), "common", "__init__.py")
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+
+
+_load_common("albert_extensions.paperless.common")
+from albert_extensions.paperless.common import (
+    AdaptiveTtl,
+    BackgroundRefresh,
+    ChangeProbe,
+    CircuitBreaker,
+    HttpClient,
+    IconCache,
+    Record,
+    SearchIndex,
+    SnapshotStore,
+    fuzzy_available,
+    metrics,
+    offline_item,
+    parse_timestamp,
+    publish_provider,
+    start_warm_up,
+    stats_items,
+    stats_query,
+    stream_page,
+    stream_records,
+)
+
 __title__ = "paperless"
 __version__ = "0.2.0"
 __triggers__ = "pl "
@@ -23,6 +64,9 @@ __authors__ = "Pete Hamlin"
 iconPath = iconLookup("paperless") or os.path.dirname(
     __file__) + "/paperless.png"
 user_agent = "org.albert.extension.python.paperless"
+snapshot_version = 3
+# Everything a listing needs but the content, servers that can't select fields send it anyway
+document_fields = "id,title,tags,document_type,created,modified"
 
 
 def initialize():
@@ -30,79 +74,74 @@ def initialize():
     config_file = ConfigParser()
     config_file.read(os.path.dirname(__file__) + "/config.ini")
     config = ApiConfig(config_file["paperless"])
+    # The combined search never waits on the server, full text hits already fetched are still used
+    publish_provider(
+        "paperless",
+        config,
+        lambda query_string, is_current: config.search_documents(query_string, is_current, server_wait=0),
+        document_item,
+        record_timestamp,
+    )
 
 
 def handleQuery(query):
     if query.isTriggered:
+        if query.string.strip() == stats_query:
+            return stats_items("paperless", __title__, iconPath)
         return show_documents(query)
 
 
 def show_documents(query) -> List[Item]:
     results = []
-    for document in config.get_documents():
-        title = document["title"]
-        filters = [title]
-        if config.parse_tags:
-            tags = ", ".join([config.parse_tag(tag) for tag in document["tags"]])
-            if tags:
-                filters.append(tags)
-        if config.parse_document_type:
-            doc_type = config.parse_type(document.get("document_type"))
-            if doc_type:
-                filters.append(tags)
-        if config.search_body and document.get("body"):
-            filters.append(document.get("body"))
-        debug(f"Got filters: {filters}")
-        if filter_query(query.string, filters):
-            debug(f"Got document: {title} - query string {query.string}")
-            subtext = " - ".join(filters)
-            preview_url = url = "{}/api/documents/{}/preview/".format(config.base_url, document["id"])
-            download_url = url = "{}/api/documents/{}/download/".format(config.base_url, document["id"])
-            results.append(
-                Item(
-                    id=__title__,
-                    icon=iconPath,
-                    text=title,
-                    subtext=subtext,
-                    completion=f"{__triggers__} {query.string}",
-                    actions=[
-                        FuncAction("Download Document", callable=lambda url=download_url: download_file(url)),
-                        # UrlAction(text="Download Document", url=download_url),
-                        UrlAction(text="Open Document in browser", url=preview_url),
-                        ClipAction(text="Copy Preview URL", clipboardText=preview_url),
-                        ClipAction(text="Copy Download URL", clipboardText=download_url),
-                    ],
-                )
+    for facet, completed in config.facet_completions(query.string):
+        results.append(
+            Item(
+                id=__title__,
+                icon=iconPath,
+                text=facet,
+                subtext="Only show documents with this {}".format("tag" if facet.startswith("tag:") else "type"),
+                completion=f"{__triggers__}{completed}",
             )
+        )
+    records = config.search_documents(query.string, lambda: query.isValid)
+    with metrics.timed("items"):
+        for record in records:
+            debug(f"Got document: {record.title} - query string {query.string}")
+            results.append(document_item(record, f"{__triggers__} {query.string}"))
+    metrics.count("items shown", len(records))
     if not results:
         results.append(
             Item(
                 id=__title__,
                 icon=iconPath,
-                text="No documents found",
+                text="Refreshing documents..." if config.loading else "No documents found",
                 actions=[
-                    UrlAction(text="Open linkding", url=config.base_url)
+                    UrlAction(text="Open paperless", url=config.base_url)
                 ])),
+    if config.breaker.is_open:
+        results.insert(0, offline_item(__title__, iconPath, "paperless", "documents", config))
     return results
 
 
-def filter_query(query_string: str, filters: List[str]) -> bool:
-    for item in filters:
-        if query_string in item.lower():
-            return True
-    return False
-
-def download_file(url: str) -> None:
-    response = requests.get(url, timeout=5, auth=(config.username, config.password))
-    if response.ok:
-        header = response.headers.get("Content-Disposition").split('filename=')[1] or "albert_paperless_dl.pdf"
-        local_name = os.path.expanduser("{}/{}".format(config.download_path, header).replace('"', ''))
-        with open(local_name, "wb") as dl_file:
-            for chunk in response.iter_content(chunk_size=8192):
-                dl_file.write(chunk)
-        os.system(f"xdg-open '{local_name}'")
+def document_item(record: "DocumentRecord", completion: str) -> Item:
+    return Item(
+        id=__title__,
+        icon=config.icons.get(record.thumb_key, record.thumb_url),
+        text=record.title,
+        subtext=record.subtext,
+        completion=completion,
+        actions=[
+            FuncAction("Download Document", callable=lambda record=record: download_file(record)),
+            # UrlAction(text="Download Document", url=download_url),
+            UrlAction(text="Open Document in browser", url=record.preview_url),
+            ClipAction(text="Copy Preview URL", clipboardText=record.preview_url),
+            ClipAction(text="Copy Download URL", clipboardText=record.download_url),
+        ],
+    )
 
 
+def download_file(record: "DocumentRecord") -> None:
+    config.downloads.open(record)
 
 
 class ApiConfig:
@@ -112,75 +151,748 @@ class ApiConfig:
         self.base_url = config["base_url"]
         self.download_path = config["download_path"]
         self.search_body = config.getboolean("search_body")
+        # Either ask paperless's own full text search, or download and index every body locally
+        self.server_search = self.search_body and config.getboolean("server_search", fallback=True)
+        self.index_bodies = self.search_body and not self.server_search
         self.parse_tags = config.getboolean("parse_tags")
         self.parse_document_type = config.getboolean("parse_document_type")
+        self.incremental_sync = config.getboolean("incremental_sync", fallback=True)
+        self.max_results = config.getint("max_results", fallback=50)
+        self.fuzzy = config.getboolean("fuzzy", fallback=False) and fuzzy_available()
+        self.server_search_wait = config.getfloat("server_search_wait", fallback=0.5)
+        self.http = HttpClient(user_agent)
+        self.http.session.auth = (self.username, self.password)
+        icon_cache_size = config.getint("icon_cache_size", fallback=20) * 1024 * 1024
+        self.icons = IconCache("paperless", self.http, icon_cache_size, iconPath)
+        self.downloads = DownloadCache(
+            self.http, self.download_path, config.getint("download_cache_size", fallback=500) * 1024 * 1024
+        )
         self.documents = []
+        self.index = SearchIndex([], record_fields, record_timestamp, self.fuzzy)
+        self.facets = FacetIndex(self.index)
         self.doc_expiry = datetime.now()
+        min_ttl = timedelta(minutes=config.getint("min_ttl", fallback=5))
+        max_ttl = timedelta(minutes=config.getint("max_ttl", fallback=120))
+        self.doc_ttl = AdaptiveTtl(timedelta(minutes=30), min_ttl, max_ttl)
+        self.probe = ChangeProbe(self.http)
+        self.reconcile_expiry = datetime.now()
+        self.synced = None
+        # One breaker for the whole instance, if documents fail so will tags
+        self.breaker = CircuitBreaker()
+        self.doc_store = SnapshotStore("paperless", "documents", snapshot_version)
+        self.doc_refresher = BackgroundRefresh("paperless document refresh", self._refresh_documents, self.breaker)
+        self.tags = {}
+        self.tag_expiry = datetime.now()
+        self.tag_ttl = AdaptiveTtl(timedelta(minutes=60), min_ttl, max_ttl)
+        self.tag_store = SnapshotStore("paperless", "tags", snapshot_version)
+        self.tag_refresher = BackgroundRefresh("paperless tag refresh", self._refresh_tags, self.breaker)
+        self.document_types = {}
+        self.type_expiry = datetime.now()
+        self.type_ttl = AdaptiveTtl(timedelta(minutes=60), min_ttl, max_ttl)
+        self.type_store = SnapshotStore("paperless", "document_types", snapshot_version)
+        self.type_refresher = BackgroundRefresh("paperless type refresh", self._refresh_types, self.breaker)
+        # Document content is only fetched when it's searched, separately from the listing
+        self.bodies = {}
+        self.body_store = SnapshotStore("paperless", "bodies", snapshot_version)
+        self.body_refresher = BackgroundRefresh("paperless body refresh", self._refresh_bodies, self.breaker)
+        self.remote = RemoteSearch("paperless server search", self._search_server)
+        # Records are built from the documents, tags, types and bodies, which
+        # separate refreshes replace. Holding this while swapping any of them
+        # in and while building records keeps the index consistent with all four
+        self._records_lock = threading.Lock()
+        self.ready = threading.Event()
+        start_warm_up("paperless warm-up", self._warm_up)
 
-        if self.parse_tags:
-            self.tags = {}
-            self.tag_expiry = datetime.now()
-            self._refresh_tags()
-
-        if self.parse_document_type:
-            self.document_types = {}
-            self.type_expiry = datetime.now()
-            self._refresh_types()
+    @property
+    def loading(self) -> bool:
+        return not self.ready.is_set() or self.doc_refresher.running
 
-    def get_documents(self) -> List[Dict]:
+    def _warm_up(self):
+        try:
+            self._load_documents()
+            if self.index_bodies:
+                self._load_bodies()
+            tags_loaded = not self.parse_tags or self._load_tags()
+            types_loaded = not self.parse_document_type or self._load_types()
+            self._rebuild_index()
+        finally:
+            self.ready.set()
+        # Documents from the snapshot are searchable by title meanwhile, their
+        # tag and type names are filled in as soon as these arrive
+        if not tags_loaded:
+            self.tag_refresher.run()
+        if not types_loaded:
+            self.type_refresher.run()
+        if self.index_bodies:
+            # Picks up documents whose body is missing from an older snapshot
+            self.body_refresher.trigger()
         if self.doc_expiry < datetime.now():
-            self._refresh_documents()
-        return self.documents
-
-    def parse_tag(self, tag: int) -> str:
-        if self.tag_expiry < datetime.now():
-            self._refresh_tags()
-        return self.tags.get(tag)
-
-    def parse_type(self, doc_type: int) -> str:
-        if doc_type:
-            if self.type_expiry < datetime.now():
-                self._refresh_types()
-            return self.document_types.get(doc_type)
-        return None
+            self.doc_refresher.trigger()
+
+    def search_documents(
+        self, query_string: str, is_current: Callable[[], bool] = lambda: True, server_wait: Optional[float] = None
+    ) -> List["DocumentRecord"]:
+        """Local matches, plus full text hits from the server if they arrive within `server_wait`.
+
+        `server_wait` defaults to `server_search_wait`, with 0 only hits the
+        server has already sent are used."""
+        now = datetime.now()
+        if self.ready.is_set():
+            if self.doc_expiry < now:
+                self.doc_refresher.trigger()
+            if self.parse_tags and self.tag_expiry < now:
+                self.tag_refresher.trigger()
+            if self.parse_document_type and self.type_expiry < now:
+                self.type_refresher.trigger()
+        with metrics.timed("filter"):
+            tag_values, type_values, text = self.parse_facets(query_string)
+            within = None
+            if tag_values or type_values:
+                # Read the pair once, a refresh may swap in a new index meanwhile
+                facets = self.facets
+                index = facets.index
+                within = facets.matching(
+                    [self._facet_ids(self.tags, value) for value in tag_values],
+                    [self._facet_ids(self.document_types, value) for value in type_values],
+                )
+                records = index.top(text, self.max_results, within)
+            else:
+                index = self.index
+                records = index.top(text, self.max_results)
+        if self.server_search and len(text) >= 3 and self.breaker.allow():
+            # Superseded keystrokes return their local matches as soon as albert flags them stale
+            self.remote.request(text)
+            wait = self.server_search_wait if server_wait is None else server_wait
+            hits = self.remote.wait(text, wait, is_current)
+            if hits:
+                records = self._merge_hits(index, records, hits, within)
+        return records
+
+    def parse_facets(self, query_string: str) -> Tuple[List[str], List[str], str]:
+        """Split `tag:<slug>` and `type:<slug>` filters off a query.
+
+        Returns the tag and type values and the remaining free text. Filters
+        for tags or types that aren't being parsed are left in the text."""
+        enabled = {"tag": self.parse_tags, "type": self.parse_document_type}
+        if ":" not in query_string:
+            return [], [], query_string
+        values = {"tag": [], "type": []}
+        words = []
+        for token in query_string.split():
+            name, _, value = token.partition(":")
+            if value and enabled.get(name):
+                values[name].append(value.lower())
+            else:
+                words.append(token)
+        if not (values["tag"] or values["type"]):
+            return [], [], query_string
+        return values["tag"], values["type"], " ".join(words)
+
+    def facet_completions(self, query_string: str) -> List[Tuple[str, str]]:
+        """Suggest tag/type slugs for a filter that's still being typed."""
+        if not query_string or query_string[-1].isspace():
+            return []
+        head, _, token = query_string.rpartition(" ")
+        name, separator, value = token.partition(":")
+        slugs = {
+            "tag": self.tags if self.parse_tags else {},
+            "type": self.document_types if self.parse_document_type else {},
+        }
+        if not separator or name not in slugs:
+            return []
+        value = value.lower()
+        matching = sorted(slug for slug in set(slugs[name].values()) if slug.startswith(value))
+        if matching == [value]:
+            return []
+        prefix = f"{head} " if head else ""
+        return [(f"{name}:{slug}", f"{prefix}{name}:{slug} ") for slug in matching[:10]]
+
+    @staticmethod
+    def _facet_ids(slugs: Dict[int, str], value: str) -> set:
+        # An exact slug wins, otherwise a partly typed one matches every slug it starts
+        exact = {slug_id for slug_id, slug in slugs.items() if slug == value}
+        return exact or {slug_id for slug_id, slug in slugs.items() if slug.startswith(value)}
+
+    def _merge_hits(
+        self, index: "SearchIndex", records: List["DocumentRecord"], hits: List[int], within: Optional[set]
+    ) -> List["DocumentRecord"]:
+        """Append full text hits after the local matches, keeping room for at least half of them.
+
+        Hits outside `within` (the positions left by any facet filters) are dropped."""
+        seen = {record.id for record in records}
+        missing = set(hits) - seen
+        if not missing:
+            return records
+        found = {
+            record.id: record for position, record in enumerate(index.records)
+            if record and record.id in missing and (within is None or position in within)
+        }
+        extra = [found[doc_id] for doc_id in hits if doc_id in found]
+        keep = self.max_results - min(len(extra), self.max_results // 2)
+        return (records[:keep] + extra)[:self.max_results]
+
+    def _search_server(self, query_string: str) -> List[int]:
+        url = "{}/api/documents/?query={}&fields=id&page_size={}".format(
+            self.base_url, parse.quote(query_string), self.max_results
+        )
+        debug("About to GET {}".format(url))
+        with metrics.timed("server search"):
+            return [result["id"] for result in stream_page(self.http, url).records()]
+
+    def retry(self):
+        self.breaker.reset()
+        self.doc_refresher.trigger()
 
     def _refresh_documents(self):
-        url = f"{self.base_url}/api/documents/"
+        if self.incremental_sync and self.documents:
+            # A delta sync is already as cheap as any probe
+            changed = self._sync_documents()
+            if changed is None:
+                self._crawl_documents()
+                changed = True
+        else:
+            probe_url = f"{self.base_url}/api/documents/?page_size=1&fields=id,modified&ordering=-modified"
+            changed = self.probe.changed(probe_url, listing_fingerprint)
+            if changed:
+                self._crawl_documents()
+                self.probe.confirm()
+        self.synced = datetime.now()
+        if not changed:
+            self.doc_expiry = self.synced + self.doc_ttl.unchanged()
+            debug(f"Documents unchanged, next check in {self.doc_ttl.current}")
+            metrics.note(changed=False, next_check=str(self.doc_ttl.current))
+            return
+        self.doc_expiry = self.synced + self.doc_ttl.changed()
+        metrics.note(changed=True, records=len(self.documents), next_check=str(self.doc_ttl.current))
+        self.doc_store.save([document.to_row() for document in self.documents])
+        if self.index_bodies:
+            self.body_refresher.trigger()
+
+    def _crawl_documents(self):
+        url = f"{self.base_url}/api/documents/?fields={document_fields}"
+        debug("About to GET {}".format(url))
+        self.documents = list(stream_records(self.http, url, Document.from_api))
+        self._rebuild_index()
+        self.reconcile_expiry = datetime.now() + timedelta(hours=3)
+
+    def _sync_documents(self) -> Optional[bool]:
+        """Fetch only documents modified since the newest one we know about.
+
+        Deletions don't show up in a modification filter, so every few hours
+        the known IDs are reconciled against the full ID list paperless hands
+        out with any listing. Returns whether anything changed, or None when
+        a full crawl is needed instead."""
+        watermark = max(self.documents, key=modified_at).modified
+        url = f"{self.base_url}/api/documents/?fields={document_fields}&modified__gt={parse.quote(watermark)}"
+        debug("About to GET {}".format(url))
+        changed = list(stream_records(self.http, url, Document.from_api))
+
+        documents = {document.id: document for document in self.documents}
+        for document in changed:
+            documents[document.id] = document
+        deleted = set()
+        if self.reconcile_expiry < datetime.now():
+            server_ids = self._fetch_document_ids()
+            if server_ids is None:
+                return None
+            deleted = documents.keys() - server_ids
+            if len(documents) - len(deleted) != len(server_ids):
+                debug("Document IDs out of step with the server, doing a full crawl")
+                return None
+            self.reconcile_expiry = datetime.now() + timedelta(hours=3)
+
+        debug(f"Synced {len(changed)} changed and {len(deleted)} deleted documents")
+        if changed or deleted:
+            for doc_id in deleted:
+                del documents[doc_id]
+            self.documents = list(documents.values())
+            self._apply_changes(changed, deleted)
+        return bool(changed or deleted)
+
+    def _fetch_document_ids(self) -> Optional[set]:
+        url = f"{self.base_url}/api/documents/?page_size=1&fields=id"
         debug("About to GET {}".format(url))
-        documents = []
-        while url:
-            results, url = self._parse_results(url)
-            documents += results
-        self.documents = documents
-        self.doc_expiry = datetime.now() + timedelta(minutes=30)
+        response = self.http.get(url)
+        if not response.ok:
+            error('Got response {}'.format(response))
+            response.raise_for_status()
+        result = response.json()
+        if "all" not in result:
+            debug("Server doesn't list document IDs, doing a full crawl")
+            return None
+        return set(result["all"])
+
+    def _apply_changes(self, changed: List["Document"], deleted: set):
+        with self._records_lock:
+            index, facets = self.index, self.facets
+            positions = {record.id: position for position, record in enumerate(index.records) if record}
+            records = [DocumentRecord(document, self) for document in changed]
+            for record in records:
+                if record.id in positions:
+                    position = positions[record.id]
+                    facets.remove(position, index.records[position])
+                    index.update(position, record)
+                    facets.add(position, record)
+                else:
+                    facets.add(index.add(record), record)
+            for doc_id in deleted:
+                if doc_id in positions:
+                    facets.remove(positions[doc_id], index.records[positions[doc_id]])
+                    index.remove(positions[doc_id])
+        index.rebuild_fuzzy()
+        self._prefetch_thumbnails(records)
 
     def _refresh_tags(self):
         url = f"{self.base_url}/api/tags/"
         debug("About to GET {}".format(url))
         tags = {}
-        while url:
-            results, url = self._parse_results(url)
-            for result in results:
-                tags[result['id']] = result['slug']
-        self.tags = tags
-        self.tag_expiry = datetime.now() + timedelta(minutes=60)
+        for result in stream_records(self.http, url):
+            tags[result['id']] = result['slug']
+        with self._records_lock:
+            changed = changed_keys(self.tags, tags)
+            self.tags = tags
+            self._invalidate_records(lambda record: not changed.isdisjoint(record.tag_ids))
+        self.index.rebuild_fuzzy()
+        self.tag_expiry = datetime.now() + (self.tag_ttl.changed() if changed else self.tag_ttl.unchanged())
+        self.tag_store.save(tags)
 
     def _refresh_types(self):
         url = f"{self.base_url}/api/document_types/"
         debug("About to GET {}".format(url))
         doc_types = {}
-        while url:
-            results, url = self._parse_results(url)
-            for result in results:
-                doc_types[result['id']] = result['slug']
-        self.document_types = doc_types
-        self.type_expiry = datetime.now() + timedelta(minutes=60)
-
-    def _parse_results(self, url) -> Tuple[List[Dict], str]:
-        response = requests.get(url, timeout=5, auth=(self.username, self.password))
-        if response.ok:
-            result = response.json()
-            return result["results"], result["next"]
+        for result in stream_records(self.http, url):
+            doc_types[result['id']] = result['slug']
+        with self._records_lock:
+            changed = changed_keys(self.document_types, doc_types)
+            self.document_types = doc_types
+            self._invalidate_records(lambda record: record.type_id in changed)
+        self.index.rebuild_fuzzy()
+        self.type_expiry = datetime.now() + (self.type_ttl.changed() if changed else self.type_ttl.unchanged())
+        self.type_store.save(doc_types)
+
+    def _refresh_bodies(self):
+        """Fetch the content of every document whose body we don't have yet.
+
+        Only new and modified documents are asked for, by ID, unless most of
+        them are missing anyway (e.g. on the first refresh) in which case the
+        plain listing is cheaper."""
+        documents = self.documents
+        stale = [
+            document.id for document in documents if self.bodies.get(document.id, (None,))[0] != document.modified
+        ]
+        bodies = {document.id: self.bodies[document.id] for document in documents if document.id in self.bodies}
+        url = f"{self.base_url}/api/documents/?fields=id,modified,content"
+        if len(stale) > len(documents) // 2:
+            urls = [url]
         else:
-            error('Got response {}'.format(response))
-            return [], ""
+            urls = [
+                f"{url}&id__in={','.join(map(str, stale[start:start + 100]))}"
+                for start in range(0, len(stale), 100)
+            ]
+        fetched = set()
+        for url in urls:
+            debug("About to GET {}".format(url))
+            for result in stream_records(self.http, url):
+                bodies[result["id"]] = (result.get("modified"), result.get("content") or "")
+                fetched.add(result["id"])
+        debug(f"Fetched {len(fetched)} document bodies")
+        if not fetched and len(bodies) == len(self.bodies):
+            return
+        with self._records_lock:
+            self.bodies = bodies
+            self._invalidate_records(lambda record: record.id in fetched)
+        self.index.rebuild_fuzzy()
+        self.body_store.save(bodies)
+
+    def _rebuild_index(self):
+        with self._records_lock:
+            records = [DocumentRecord(document, self) for document in self.documents]
+            index = SearchIndex(records, record_fields, record_timestamp, self.fuzzy)
+            self.facets = FacetIndex(index)
+            self.index = index
+        self._prefetch_thumbnails(records)
+
+    def _prefetch_thumbnails(self, records: List["DocumentRecord"]):
+        newest = sorted(records, key=record_timestamp, reverse=True)[:self.icons.prefetch_limit]
+        self.icons.prefetch({record.thumb_key: record.thumb_url for record in newest})
+
+    def _invalidate_records(self, is_stale: Callable[["DocumentRecord"], bool]):
+        # Only documents referencing a renamed, added or removed tag/type need
+        # their resolved names rebuilding, everything else stays as it is.
+        # Called with the records lock held
+        index = self.index
+        stale = [position for position, record in enumerate(index.records) if record and is_stale(record)]
+        for position in stale:
+            index.update(position, DocumentRecord(index.records[position].document, self))
+        if stale:
+            debug(f"Rebuilt {len(stale)} document records")
+
+    def _load_documents(self) -> bool:
+        snapshot = self.doc_store.load(lambda rows: [Document(*row) for row in rows])
+        if snapshot:
+            self.documents, self.synced = snapshot
+            self.doc_expiry = self.synced + self.doc_ttl.current
+            debug(f"Loaded {len(self.documents)} documents from snapshot")
+        return bool(snapshot)
+
+    def _load_bodies(self):
+        snapshot = self.body_store.load(
+            lambda bodies: {int(doc_id): tuple(body) for doc_id, body in bodies.items()}
+        )
+        if snapshot:
+            self.bodies, _ = snapshot
+
+    def _load_tags(self) -> bool:
+        # JSON object keys are always strings, the API hands out integer IDs
+        snapshot = self.tag_store.load(lambda tags: {int(tag_id): slug for tag_id, slug in tags.items()})
+        if snapshot:
+            self.tags, synced = snapshot
+            self.tag_expiry = synced + self.tag_ttl.current
+        return bool(snapshot)
+
+    def _load_types(self) -> bool:
+        snapshot = self.type_store.load(
+            lambda doc_types: {int(type_id): slug for type_id, slug in doc_types.items()}
+        )
+        if snapshot:
+            self.document_types, synced = snapshot
+            self.type_expiry = synced + self.type_ttl.current
+        return bool(snapshot)
+
+
+class Document(Record):
+    """The parts of a paperless document the extension keeps between refreshes.
+
+    Listings are requested without the document content, which is by far
+    the largest part of them, see `ApiConfig.bodies`. The modification time
+    stays the raw string paperless sent, it's handed back verbatim as the
+    sync watermark."""
+
+    __slots__ = ("id", "title", "tags", "document_type", "created", "modified")
+
+    def __init__(
+        self,
+        id: int,
+        title: str,
+        tags: Tuple[int, ...],
+        document_type: Optional[int],
+        created: float,
+        modified: Optional[str],
+    ):
+        self.id = id
+        self.title = title
+        self.tags = tuple(tags)
+        self.document_type = document_type
+        self.created = created
+        self.modified = modified
+
+    @classmethod
+    def from_api(cls, document: Dict) -> "Document":
+        return cls(
+            document["id"],
+            document["title"],
+            document["tags"],
+            document.get("document_type"),
+            parse_timestamp(document.get("created")),
+            document.get("modified"),
+        )
+
+
+class DocumentRecord:
+    """Everything a query needs to know about a document, resolved up front.
+
+    Tag and document type IDs are turned into their slugs and the display
+    strings and URLs are built once per refresh instead of on every
+    keystroke."""
+
+    __slots__ = (
+        "document", "id", "title", "tag_ids", "type_id", "tag_names", "type_name", "body", "created",
+        "modified", "subtext", "preview_url", "download_url", "thumb_key", "thumb_url",
+    )
+
+    def __init__(self, document: Document, config: "ApiConfig"):
+        self.document = document
+        self.id = document.id
+        self.title = document.title
+        self.tag_ids = document.tags
+        self.type_id = document.document_type
+        self.tag_names = None
+        if config.parse_tags:
+            self.tag_names = ", ".join(filter(None, (config.tags.get(tag) for tag in self.tag_ids)))
+        self.type_name = None
+        if config.parse_document_type and self.type_id:
+            self.type_name = config.document_types.get(self.type_id)
+        self.body = config.bodies.get(self.id, (None, None))[1] if config.index_bodies else None
+        self.created = document.created
+        self.modified = modified_at(document)
+        self.subtext = " - ".join(filter(None, (self.title, self.tag_names, self.type_name)))
+        self.preview_url = "{}/api/documents/{}/preview/".format(config.base_url, self.id)
+        self.download_url = "{}/api/documents/{}/download/".format(config.base_url, self.id)
+        # Thumbnails change along with the document
+        self.thumb_key = f"{self.id}-{int(self.modified)}"
+        self.thumb_url = "{}/api/documents/{}/thumb/".format(config.base_url, self.id)
+
+
+class FacetIndex:
+    """Positions of the documents carrying each tag and document type.
+
+    Kept in step with the search index it was built from, so `tag:` and
+    `type:` filters are set intersections rather than string scans. Tag and
+    type renames don't touch it, only the IDs are stored."""
+
+    def __init__(self, index: "SearchIndex"):
+        self.index = index
+        self.tags = defaultdict(set)
+        self.types = defaultdict(set)
+        self._lock = threading.Lock()
+        for position, record in enumerate(index.records):
+            if record:
+                self.add(position, record)
+
+    def add(self, position: int, record: "DocumentRecord"):
+        with self._lock:
+            for tag_id in record.tag_ids:
+                self.tags[tag_id].add(position)
+            if record.type_id is not None:
+                self.types[record.type_id].add(position)
+
+    def remove(self, position: int, record: "DocumentRecord"):
+        with self._lock:
+            for tag_id in record.tag_ids:
+                self.tags[tag_id].discard(position)
+            if record.type_id is not None:
+                self.types[record.type_id].discard(position)
+
+    def matching(self, tag_filters: List[set], type_filters: List[set]) -> set:
+        """Positions matching every filter, each filter being a set of acceptable IDs."""
+        filters = [(self.tags, ids) for ids in tag_filters] + [(self.types, ids) for ids in type_filters]
+        with self._lock:
+            matches = None
+            for facet, ids in filters:
+                positions = set().union(*(facet.get(facet_id, ()) for facet_id in ids))
+                matches = positions if matches is None else matches & positions
+                if not matches:
+                    return set()
+            return matches or set()
+
+
+def listing_fingerprint(result: Dict) -> Tuple:
+    return result["count"], [(document["id"], document.get("modified")) for document in result["results"]]
+
+
+def modified_at(document: Document) -> float:
+    return parse_timestamp(document.modified)
+
+
+def record_fields(record: DocumentRecord) -> List[str]:
+    return [record.title, record.tag_names, record.type_name, record.body]
+
+
+def record_timestamp(record: DocumentRecord) -> float:
+    return record.created
+
+
+def changed_keys(old: Dict, new: Dict) -> set:
+    return {key for key in old.keys() | new.keys() if old.get(key) != new.get(key)}
+
+
+class DownloadCache:
+    """Fetches documents in the background into a size-bounded local cache.
+
+    Files are keyed by document ID and modification time, so opening a
+    document again skips the network until it changes on the server.
+    Downloads stream into a `.part` file that is resumed with a Range request
+    if a previous attempt was cut short, and only once it's complete is it
+    renamed into the cache, placed in the download directory and opened.
+    The least recently opened files are evicted once the cache grows past
+    `max_bytes`."""
+
+    def __init__(self, http: "HttpClient", download_path: str, max_bytes: int):
+        self.http = http
+        self.path = os.path.join(cacheLocation(), "paperless", "files")
+        self.download_path = os.path.expanduser(download_path.replace('"', ""))
+        self.max_bytes = max_bytes
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def open(self, record: "DocumentRecord"):
+        key = f"{record.id}-{int(record.modified)}"
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+        threading.Thread(target=self._open, args=(record, key), name="paperless download", daemon=True).start()
+
+    def _open(self, record: "DocumentRecord", key: str):
+        try:
+            path = self._cached(key) or self._download(record.download_url, key)
+            subprocess.Popen(["xdg-open", self._publish(path)])
+        except (requests.RequestException, OSError) as err:
+            warning(f"Could not download {record.title}: {err}")
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    def _cached(self, key: str) -> Optional[str]:
+        if not os.path.isdir(self.path):
+            return None
+        for name in os.listdir(self.path):
+            if name.startswith(f"{key}--"):
+                path = os.path.join(self.path, name)
+                # Bump the mtime, eviction goes by least recently used
+                os.utime(path)
+                debug(f"Serving {name} from cache")
+                return path
+        return None
+
+    def _download(self, url: str, key: str) -> str:
+        os.makedirs(self.path, exist_ok=True)
+        part_path = os.path.join(self.path, f"{key}.part")
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        response = self._request(url, offset)
+        if response.status_code == 416 and offset:
+            # Whatever we have can't be resumed, start again from the beginning
+            response.close()
+            os.remove(part_path)
+            response = self._request(url, 0)
+        with response:
+            response.raise_for_status()
+            # A plain 200 means the server ignored the range and sent everything
+            mode = "ab" if response.status_code == 206 else "wb"
+            with open(part_path, mode) as part_file:
+                for chunk in response.iter_content(chunk_size=65536):
+                    part_file.write(chunk)
+            filename = attachment_name(response)
+        path = os.path.join(self.path, f"{key}--{filename}")
+        os.replace(part_path, path)
+        self._evict(keep=path)
+        return path
+
+    def _request(self, url: str, offset: int) -> requests.Response:
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        debug("About to GET {} from byte {}".format(url, offset))
+        return self.http.get(url, stream=True, headers=headers)
+
+    def _publish(self, path: str) -> str:
+        target = os.path.join(self.download_path, os.path.basename(path).split("--", 1)[1])
+        if not (os.path.exists(target) and os.path.samefile(path, target)):
+            tmp_path = f"{target}.tmp"
+            try:
+                os.link(path, tmp_path)
+            except OSError:
+                shutil.copyfile(path, tmp_path)
+            os.replace(tmp_path, target)
+        return target
+
+    def _evict(self, keep: str):
+        entries = []
+        for name in os.listdir(self.path):
+            # Downloads still in progress belong to their own thread
+            if name.endswith(".part"):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # Evicted by a concurrent download meanwhile
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path != keep:
+                debug(f"Evicting {path} from the download cache")
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+
+
+def attachment_name(response: requests.Response) -> str:
+    disposition = response.headers.get("Content-Disposition", "")
+    if "filename=" in disposition:
+        name = os.path.basename(disposition.split("filename=")[1].split(";")[0].replace('"', ""))
+        if name:
+            return name
+    return "albert_paperless_dl.pdf"
+
+
+class RemoteSearch:
+    """Runs full text queries against the server off the query thread.
+
+    Requests are debounced on the worker: only the newest query is sent once
+    typing pauses for `debounce` seconds, and anything superseded in the
+    meantime never hits the network. A caller waits through the debounce and
+    the request for as long as its query is the current one, albert flags a
+    query stale as soon as the next keystroke arrives, so in practice only
+    the last keystroke waits. Results for the last few queries are kept, so
+    running a query again shows its results without another request."""
+
+    def __init__(self, name: str, search: Callable[[str], List[int]], debounce: float = 0.25, size: int = 32):
+        self.search = search
+        self.debounce = debounce
+        self.size = size
+        self._results = OrderedDict()
+        self._pending = None
+        self._requested = 0.0
+        self._current = None
+        self._condition = threading.Condition()
+        threading.Thread(target=self._work, name=name, daemon=True).start()
+
+    def request(self, query_string: str):
+        with self._condition:
+            if query_string in self._results:
+                self._results.move_to_end(query_string)
+                return
+            if query_string not in (self._pending, self._current):
+                self._pending = query_string
+                self._requested = time.monotonic()
+                self._condition.notify_all()
+
+    def wait(self, query_string: str, timeout: float, is_current: Callable[[], bool]) -> Optional[List[int]]:
+        """Return the results for a query, waiting while it's current for up to `timeout` once it's sent.
+
+        With a `timeout` of 0 only results that have already arrived are returned."""
+        sent = None
+        with self._condition:
+            while query_string not in self._results:
+                if timeout <= 0 or not is_current():
+                    return None
+                if query_string == self._current:
+                    sent = sent or time.monotonic()
+                    remaining = sent + timeout - time.monotonic()
+                    if remaining <= 0:
+                        return None
+                elif query_string == self._pending:
+                    # Still in its quiet period, it's sent once typing pauses
+                    remaining = self.debounce
+                else:
+                    return None
+                # Wake up regularly, albert only flags stale queries
+                self._condition.wait(min(remaining, 0.05))
+            return self._results[query_string]
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while self._pending is None:
+                    self._condition.wait()
+                # Every new request restarts the quiet period
+                while time.monotonic() - self._requested < self.debounce:
+                    self._condition.wait(self.debounce - (time.monotonic() - self._requested))
+                query_string, self._pending = self._pending, None
+                self._current = query_string
+            try:
+                results = self.search(query_string)
+            except (requests.RequestException, ValueError, KeyError) as err:
+                warning(f"Server search for {query_string!r} failed: {err}")
+                results = None
+            with self._condition:
+                self._current = None
+                if results is not None:
+                    self._results[query_string] = results
+                    while len(self._results) > self.size:
+                        self._results.popitem(last=False)
+                self._condition.notify_all()
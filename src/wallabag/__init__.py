@@ -11,14 +11,56 @@ wallabag instance. Search supports both title and tags.
 
 Synopsis: <trigger> <query>"""
 
+import bisect
+import contextvars
+import heapq
+import importlib.util
 import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
 from datetime import datetime, timedelta
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
+from urllib import parse
 
 import requests
 from albert import *
 
+
+def _load_common(name: str):
+    # albert runs an extension from its file without registering it in sys.modules, so a
+    # relative import of the bundled common package has no parent to resolve against
+    path = os.path.join(os.path.dirname(__file__), "common", "__init__.py")
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+
+
+_load_common("albert_extensions.wallabag.common")
+from albert_extensions.wallabag.common import (
+    AdaptiveTtl,
+    BackgroundRefresh,
+    ChangeProbe,
+    CircuitBreaker,
+    HttpClient,
+    IconCache,
+    ListingStream,
+    Record,
+    SearchIndex,
+    SnapshotStore,
+    fuzzy_available,
+    metrics,
+    offline_item,
+    parse_timestamp,
+    publish_provider,
+    start_warm_up,
+    stats_items,
+    stats_query,
+    stream_page,
+)
+
 __title__ = "Wallabag"
 __version__ = "0.2.1"
 __triggers__ = "wb "
@@ -28,6 +70,7 @@ __authors__ = "Pete Hamlin"
 iconPath = iconLookup("wallabag") or os.path.dirname(
     __file__) + "/wallabag.png"
 user_agent = "org.albert.extension.python.wallabag"
+snapshot_version = 2
 
 
 def initialize():
@@ -35,54 +78,59 @@ def initialize():
     config_file = ConfigParser()
     config_file.read(os.path.dirname(__file__) + "/config.ini")
     config = Config(config_file["wallabag"])
+    publish_provider(
+        "wallabag",
+        config,
+        lambda query_string, is_current: config.search_articles(query_string),
+        article_item,
+        article_timestamp,
+    )
 
 
 def handleQuery(query):
     if query.isTriggered:
+        if query.string.strip() == stats_query:
+            return stats_items("wallabag", __title__, iconPath)
         return show_articles(query)
 
 
 def show_articles(query) -> List[Item]:
     results = []
-    for article in config.get_articles():
-        title = article["title"]
-        tags = ", ".join([tag["label"] for tag in article["tags"]])
-        if filter_query(query.string, [title, tags, article["url"]]):
-            debug(f"Got article: {title} - query string {query.string}")
-            subtext = "{}: {}".format(tags, article["url"])
-            results.append(
-                Item(
-                    id=__title__,
-                    icon=iconPath,
-                    text=title,
-                    subtext=subtext,
-                    completion=f"{__triggers__} {query.string}",
-                    actions=[
-                        UrlAction(text="Open in browser", url=article["url"]),
-                        ClipAction(text="Copy URL",
-                                   clipboardText=article["url"]),
-                    ],
-                )
-            )
+    articles = config.search_articles(query.string)
+    with metrics.timed("items"):
+        for article in articles:
+            debug(f"Got article: {article.title} - query string {query.string}")
+            results.append(article_item(article, f"{__triggers__} {query.string}"))
+    metrics.count("items shown", len(results))
     if not results:
         results.append(
             Item(
                 id=__title__,
                 icon=iconPath,
-                text="No articles found",
+                text="Refreshing articles..." if config.loading else "No articles found",
                 actions=[
                     UrlAction(text="Search in Wallabag",
                               url=f"{config.base_url}/search?currentRoute=homepage&search_entry%5Bterm%5D={query}"),
                     UrlAction(text="Open Wallabag", url=config.base_url),
                 ])),
+    if config.breaker.is_open:
+        results.insert(0, offline_item(__title__, iconPath, "Wallabag", "articles", config))
     return results
 
 
-def filter_query(query_string: str, filters: List[str]) -> bool:
-    for item in filters:
-        if query_string in item.lower():
-            return True
-    return False
+def article_item(article: "Article", completion: str) -> Item:
+    return Item(
+        id=__title__,
+        icon=config.icons.get(*article_icon(article)),
+        text=article.title,
+        subtext="{}: {}".format(article.tags, article.url),
+        completion=completion,
+        actions=[
+            UrlAction(text="Open in browser", url=article.url),
+            ClipAction(text="Copy URL",
+                       clipboardText=article.url),
+        ],
+    )
 
 
 class Config:
@@ -93,80 +141,259 @@ class Config:
         self.password = config["password"]
         self.base_url = config["base_url"]
         self.per_page = config["results_per_page"]
+        self.concurrency = config.getint("concurrency", fallback=4)
+        self.max_results = config.getint("max_results", fallback=50)
+        self.fuzzy = config.getboolean("fuzzy", fallback=False) and fuzzy_available()
+        # Favicons come from the saved sites, keep the bearer token away from them
+        icon_cache_size = config.getint("icon_cache_size", fallback=20) * 1024 * 1024
+        self.icons = IconCache("wallabag", HttpClient(user_agent), icon_cache_size, iconPath)
+        self.http = HttpClient(user_agent, pool_size=self.concurrency)
         self.token = None
+        self.articles = []
+        self.index = SearchIndex([], article_fields, article_timestamp, self.fuzzy)
+        self.order = TitleOrder([])
         self.article_expiry = datetime.now()
-        self.refresh_token()
+        self.article_ttl = AdaptiveTtl(
+            timedelta(minutes=15),
+            timedelta(minutes=config.getint("min_ttl", fallback=5)),
+            timedelta(minutes=config.getint("max_ttl", fallback=120)),
+        )
+        self.probe = ChangeProbe(self.http)
+        self.synced = None
+        self.store = SnapshotStore("wallabag", "articles", snapshot_version)
+        self.breaker = CircuitBreaker()
+        self.refresher = BackgroundRefresh("wallabag refresh", self._refresh_articles, self.breaker)
+        self.ready = threading.Event()
+        start_warm_up("wallabag warm-up", self._warm_up)
+
+    @property
+    def loading(self) -> bool:
+        return not self.ready.is_set() or self.refresher.running
 
     def get_token(self):
-        if not self.token.is_valid():
+        if self.token is None or not self.token.is_valid():
             self.refresh_token()
         return self.token.access
 
     def refresh_token(self):
         url = f"{self.base_url}/oauth/v2/token"
-        response = requests.post(
-            url,
-            data={
-                "grant_type": "password",
-                "client_id": self.client_id,
-                "client_secret": self.client_secret,
-                "username": self.username,
-                "password": self.password,
-            },
-            timeout=5
-        )
+        with metrics.timed("token refresh"):
+            response = self.http.post(
+                url,
+                data={
+                    "grant_type": "password",
+                    "client_id": self.client_id,
+                    "client_secret": self.client_secret,
+                    "username": self.username,
+                    "password": self.password,
+                },
+            )
         if response.ok:
             self.token = Token(response.json())
+            self.http.session.headers["Authorization"] = f"Bearer {self.token.access}"
         else:
             warning(f"Got response {response.content}")
+            response.raise_for_status()
 
-    def get_articles(self) -> List[Dict]:
-        if self.article_expiry < datetime.now():
-            self._refresh_articles()
-        self.sort_articles()
-        debug(f"Got {len(self.articles)} articles")
-        return self.articles
-
-    def sort_articles(self) -> None:
-        existing_articles = set()
-        filtered_articles = []
-        for article in self.articles:
-            if article["url"] not in existing_articles:
-                existing_articles.add(article["url"])
-                filtered_articles.append(article)
-        self.articles = sorted(filtered_articles, key=lambda x: x["title"])
-
-    def _get_response(self, params: str = None):
-        url = f"{self.base_url}/api/entries.json?{params}"
-        header = {"Authorization": f"Bearer {self.get_token()}",
-                  "User_Agent": user_agent}
+    def search_articles(self, query_string: str) -> List["Article"]:
+        if self.ready.is_set() and self.article_expiry < datetime.now():
+            self.refresher.trigger()
+        with metrics.timed("filter"):
+            if not query_string:
+                return self.index.top(query_string, self.max_results)
+            # Titles starting with the query come first, newest first. When there
+            # are enough of them the index isn't needed at all
+            prefixed = heapq.nlargest(self.max_results, self.order.prefixed(query_string), key=article_timestamp)
+            if len(prefixed) == self.max_results:
+                return prefixed
+            seen = {article.id for article in prefixed}
+            rest = [article for article in self.index.top(query_string, self.max_results) if article.id not in seen]
+            return prefixed + rest[:self.max_results - len(prefixed)]
+
+    def retry(self):
+        self.breaker.reset()
+        self.refresher.trigger()
+
+    def _set_articles(self, articles: List["Article"]):
+        # Deduplicated and sorted once per refresh, queries are served from this view
+        order = self.order.merge(articles)
+        self.index = SearchIndex(order.articles, article_fields, article_timestamp, self.fuzzy)
+        self.order = order
+        self.articles = articles
+        self.icons.prefetch(dict(article_icon(article) for article in articles))
+
+    def _stream_page(self, page: int) -> "ListingStream":
+        # The bearer token lives on the session, callers make sure it's valid
+        url = f"{self.base_url}/api/entries.json?{self._get_params(page=page)}"
         debug(f"making GET request to {url}")
-        return requests.get(url, headers=header, timeout=5)
+        return stream_page(self.http, url, ("_embedded", "items"))
 
     def _refresh_articles(self):
-        response = self._get_response(self._get_params())
-        if response.ok:
-            self.articles = []
-            results = response.json()
-            pages = int(results["pages"])
-            debug(f"Read pages as {pages}")
-            self.articles += results["_embedded"]["items"]
-            if pages > 1:
-                for page in range(2, pages + 1):
-                    results = self._get_response(
-                        self._get_params(page=page)).json()
-                    self.articles += results["_embedded"]["items"]
-                    debug(f"Fetched {len(self.articles)}")
-            self.article_expiry = datetime.now() + timedelta(minutes=15)
+        # Validate the token once up front so page workers don't race to refresh it
+        self.get_token()
+        # The most recently updated entry and the total catch edits, additions and deletions
+        probe_url = f"{self.base_url}/api/entries.json?perPage=1&detail=metadata&sort=updated&order=desc"
+        if not self.probe.changed(probe_url, listing_fingerprint):
+            self.synced = datetime.now()
+            self.article_expiry = self.synced + self.article_ttl.unchanged()
+            debug(f"Articles unchanged, next check in {self.article_ttl.current}")
+            metrics.note(changed=False, next_check=str(self.article_ttl.current))
+            return
+        first = self._stream_page(1)
+        articles = list(first.records(Article.from_api))
+        pages = int(first.fields["pages"])
+        debug(f"Read pages as {pages}")
+        failed_pages = []
+        if pages > 1:
+            remaining = range(2, pages + 1)
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                # map() yields in submission order, so article order stays stable.
+                # Each page runs in a copy of this context to count towards this refresh
+                context = contextvars.copy_context()
+                page_items = executor.map(lambda page: context.copy().run(self._fetch_page, page), remaining)
+                for page, items in zip(remaining, page_items):
+                    if items is None:
+                        failed_pages.append(page)
+                    else:
+                        articles += items
+            debug(f"Fetched {len(articles)}")
+        self._set_articles(articles)
+        metrics.note(changed=True, records=len(articles), pages=pages)
+        if failed_pages:
+            # Keep what we got, but try again soon rather than caching a partial set
+            warning(f"Failed to fetch pages {failed_pages}, retrying shortly")
+            self.article_expiry = datetime.now() + timedelta(minutes=1)
+            metrics.note(failed_pages=failed_pages)
         else:
-            debug("Found no results")
-            self.articles = []
+            self.probe.confirm()
+            self.synced = datetime.now()
+            self.article_expiry = self.synced + self.article_ttl.changed()
+            self.store.save([article.to_row() for article in articles])
+            metrics.note(next_check=str(self.article_ttl.current))
+
+    def _fetch_page(self, page: int, attempts: int = 2) -> Optional[List["Article"]]:
+        for attempt in range(attempts):
+            try:
+                return list(self._stream_page(page).records(Article.from_api))
+            except (requests.RequestException, ValueError, KeyError) as err:
+                debug(f"Failed to fetch page {page} (attempt {attempt + 1}): {err}")
+        return None
+
+    def _warm_up(self):
+        try:
+            self._load_snapshot()
+        finally:
+            self.ready.set()
+        if self.article_expiry < datetime.now():
+            # The refresh fetches a token first
+            self.refresher.trigger()
+        else:
+            try:
+                self.get_token()
+            except requests.RequestException as err:
+                warning(f"Could not fetch a token: {err}")
+                self.breaker.failure()
+
+    def _load_snapshot(self):
+        snapshot = self.store.load(lambda rows: [Article(*row) for row in rows])
+        if snapshot:
+            articles, self.synced = snapshot
+            self._set_articles(articles)
+            self.article_expiry = self.synced + self.article_ttl.current
+            debug(f"Loaded {len(self.articles)} articles from snapshot")
 
     def _get_params(self, page: int = 1):
-        params = {"page": page, "perPage": self.per_page}
+        # Entries come with their full content unless asked not to (wallabag 2.4+)
+        params = {"page": page, "perPage": self.per_page, "detail": "metadata"}
         return "&".join(f"{key}={value}" for key, value in params.items())
 
 
+class Article(Record):
+    """The parts of a wallabag entry the extension actually uses.
+
+    Entries come with their full extracted content, which is dropped as soon
+    as a page is parsed, tags are flattened to the string the items show."""
+
+    __slots__ = ("id", "url", "title", "tags", "created")
+
+    def __init__(self, id: int, url: str, title: str, tags: str, created: float):
+        self.id = id
+        self.url = url
+        self.title = title
+        self.tags = tags
+        self.created = created
+
+    @classmethod
+    def from_api(cls, entry: Dict) -> "Article":
+        return cls(
+            entry["id"],
+            entry["url"],
+            entry.get("title") or "",
+            ", ".join(tag["label"] for tag in entry["tags"]),
+            parse_timestamp(entry.get("created_at")),
+        )
+
+
+def listing_fingerprint(result: Dict) -> Tuple:
+    newest = [(entry["id"], entry.get("updated_at")) for entry in result["_embedded"]["items"]]
+    return result["total"], newest
+
+
+class TitleOrder:
+    """Articles deduplicated by URL and sorted by lowercased title.
+
+    The sort keys are kept in a parallel list, so the titles starting with a
+    query are found by bisecting instead of scanning. A new snapshot is
+    merged into an existing order: only added or changed articles need
+    sorting, everything else keeps its place."""
+
+    def __init__(self, articles: List[Article]):
+        self.articles = articles
+        self.keys = [title_key(article) for article in articles]
+
+    def merge(self, articles: List[Article]) -> "TitleOrder":
+        unique = dedupe_articles(articles)
+        current = {tuple(article.to_row()) for article in unique}
+        kept = [article for article in self.articles if tuple(article.to_row()) in current]
+        known = {tuple(article.to_row()) for article in kept}
+        added = sorted((article for article in unique if tuple(article.to_row()) not in known), key=title_key)
+        debug(f"Merging {len(added)} new or changed articles into {len(kept)}")
+        return TitleOrder(list(heapq.merge(kept, added, key=title_key)))
+
+    def prefixed(self, query_string: str) -> List[Article]:
+        start = bisect.bisect_left(self.keys, query_string)
+        end = bisect.bisect_left(self.keys, query_string + "\U0010ffff", start)
+        return self.articles[start:end]
+
+
+def dedupe_articles(articles: List[Article]) -> List[Article]:
+    # The first article saved under a URL wins
+    seen = set()
+    unique = []
+    for article in articles:
+        if article.url not in seen:
+            seen.add(article.url)
+            unique.append(article)
+    return unique
+
+
+def title_key(article: Article) -> str:
+    return article.title.lower()
+
+
+def article_fields(article: Article) -> List[str]:
+    return [article.title, article.tags, article.url]
+
+
+def article_icon(article: Article) -> Tuple[str, str]:
+    url = parse.urlsplit(article.url)
+    return url.netloc, f"{url.scheme}://{url.netloc}/favicon.ico"
+
+
+def article_timestamp(article: Article) -> float:
+    return article.created
+
+
 class Token:
     def __init__(self, token: Dict):
         self.access = token["access_token"]
@@ -0,0 +1,6 @@
+import os
+import sys
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The bench's stand-in for albert's python module, and the shared helpers as `common`
+sys.path[:0] = [os.path.join(root, "bench"), os.path.join(root, "src")]
@@ -0,0 +1,148 @@
+import json
+
+import pytest
+import requests
+
+from common import ListingStream, stream_page
+
+
+class FakeResponse:
+    """Hands out a body in fixed size chunks, the way `iter_content` does."""
+
+    def __init__(self, body: bytes, chunk_size: int):
+        self.body = body
+        self.chunk_size = chunk_size
+        self.closed = False
+
+    def iter_content(self, chunk_size: int):
+        for start in range(0, len(self.body), self.chunk_size):
+            yield self.body[start:start + self.chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
+listing = {
+    "count": 3,
+    "next": "http://example.com/api/?page=2",
+    "results": [
+        {"id": 1, "title": "Grüße aus Köln", "tags": ["a", "b"], "score": 12345.5},
+        {"id": 22, "title": "€ and 😀", "tags": [], "score": -7},
+        {"id": 333, "title": "plain \"quoted\" \\ text", "tags": None, "score": 1e3},
+    ],
+    "previous": None,
+}
+
+
+def stream(body, chunk_size, path=("results",)):
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    response = FakeResponse(body, chunk_size)
+    return ListingStream(response, path), response
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 7, 64, 1 << 16])
+def test_records_survive_any_chunk_boundary(chunk_size):
+    page, response = stream(json.dumps(listing, ensure_ascii=False), chunk_size)
+    assert list(page.records()) == listing["results"]
+    assert page.fields == {"count": 3, "next": listing["next"], "previous": None}
+    assert response.closed
+
+
+class SplitResponse(FakeResponse):
+    """Two chunks, cut at an arbitrary byte."""
+
+    def __init__(self, body: bytes, split: int):
+        super().__init__(body, len(body))
+        self.split = split
+
+    def iter_content(self, chunk_size: int):
+        yield self.body[:self.split]
+        yield self.body[self.split:]
+
+
+def test_every_split_point():
+    body = json.dumps(listing, ensure_ascii=False, indent=1).encode("utf-8")
+    for split in range(1, len(body)):
+        page = ListingStream(SplitResponse(body, split), ("results",))
+        assert list(page.records()) == listing["results"], split
+
+
+def test_multibyte_characters_split_across_chunks():
+    title = "ü€😀" * 3
+    body = json.dumps({"results": [{"title": title}], "next": None}, ensure_ascii=False).encode("utf-8")
+    # Every character above takes 2 to 4 bytes, single byte chunks split all of them
+    page, _ = stream(body, 1)
+    assert [record["title"] for record in page.records()] == [title]
+
+
+def test_numbers_at_the_end_of_a_chunk_are_not_cut_short():
+    body = '{"results": [123456789, 2.5e10], "next": null}'
+    for chunk_size in range(1, len(body) + 1):
+        page, _ = stream(body, chunk_size)
+        assert list(page.records()) == [123456789, 2.5e10]
+
+
+def test_nested_path_and_fields_after_the_records():
+    body = json.dumps({"page": 1, "_embedded": {"items": [{"id": 1}, {"id": 2}]}, "pages": 4})
+    page, _ = stream(body, 4, ("_embedded", "items"))
+    assert [record["id"] for record in page.records(lambda item: item)] == [1, 2]
+    assert page.fields == {"page": 1, "pages": 4}
+
+
+def test_records_are_projected():
+    page, _ = stream(json.dumps(listing), 16)
+    assert list(page.records(lambda result: result["id"])) == [1, 22, 333]
+
+
+def test_empty_listing():
+    page, response = stream('{"count": 0, "next": null, "results": []}', 3)
+    assert list(page.records()) == []
+    assert page.fields == {"count": 0, "next": None}
+    assert response.closed
+
+
+@pytest.mark.parametrize("trailing", ["{}", "x", ', "more": 1'])
+def test_trailing_data_is_rejected(trailing):
+    page, response = stream('{"results": [1, 2]}' + trailing, 5)
+    with pytest.raises(ValueError):
+        list(page.records())
+    assert response.closed
+
+
+def test_trailing_whitespace_is_fine():
+    page, _ = stream('{"results": [1]} \n\t ', 2)
+    assert list(page.records()) == [1]
+
+
+@pytest.mark.parametrize("body", ['{"results": [1, 2', '{"results": [{"id": 1}', '[1, 2]', ""])
+def test_truncated_or_malformed_listings_raise(body):
+    page, response = stream(body, 3)
+    with pytest.raises(ValueError):
+        list(page.records())
+    assert response.closed
+
+
+class ErrorResponse(FakeResponse):
+    ok = False
+
+    def __init__(self):
+        super().__init__(b'{"detail": "Invalid token."}', 1 << 16)
+
+    def raise_for_status(self):
+        raise requests.HTTPError("401 Client Error")
+
+
+class FakeHttp:
+    def __init__(self, response):
+        self.response = response
+
+    def get(self, url, **kwargs):
+        return self.response
+
+
+def test_failed_page_hands_back_its_connection():
+    response = ErrorResponse()
+    with pytest.raises(requests.HTTPError):
+        stream_page(FakeHttp(response), "http://example.com/api/bookmarks/")
+    assert response.closed